@@ -20,15 +20,24 @@ __version__ = 'v1.0.0'
 
 import os.path
 import platform
+import sys
 import smbus
 import time
 import serial
 import fcntl
 import struct
-import _thread
 import threading
 import select
 import math
+import numbers
+import collections
+import heapq
+import atexit
+import array
+import asyncio
+import weakref
+import concurrent.futures
+import ctypes
 
 if platform.platform().find("Linux-2")!=-1:
 	legacy_id=True
@@ -801,10 +810,51 @@ mcuName2pinname = {
     }
 }
 
+#Connectors of each board in pin2kid (Terra uses the Daisy ones)
+pin_boards = {
+	'Arietta_G25' : ('J4',),
+	'Aria_G25'    : ('N','E','S','W'),
+	'FOX_G20'     : ('J6','J7'),
+	'Daisy'       : ('D1','D2','D3','D4','D5','D6','D7','D8',
+	                 'D10','D11','D12','D13','D14','D15','D16','D17'),
+	'Acqua_A5'    : ('J1','J2','J3')
+}
+
+#Lookup tables filled by build_pin_index()
+pin_index_legacy=None
+name2kid={}
+kid2mcuname={}
+#Board -> Kernel ID -> connector names
+kid2pinnames={}
+kid2path={}
+kid2export={}
+
+#Lines exported or requested by this process: Kernel ID -> ExportedLine
+gpio_exports={}
+gpio_exports_lock=threading.Lock()
+
+#Unexport at exit the lines still exported by this process
+release_at_exit=True
+
+#Value file descriptors kept open by set_value(), most recently used last
+gpio_fd_cache_size=64
+gpio_fd_cache=collections.OrderedDict()
+gpio_fd_lock=threading.Lock()
+
+gpio_levels = {
+	0   : b"0",
+	1   : b"1",
+	"0" : b"0",
+	"1" : b"1"
+}
+
 def getVersion ():
 	return __version__
 
-def get_gpio_path(kernel_id):
+def gpio_sysfs_path(kernel_id):
+	"""
+	Compose the sysfs path of a GPIO line from its Kernel ID
+	"""
 	global legacy_id
 	kernel_id=kernel_id-32	
 	
@@ -825,50 +875,267 @@ def get_gpio_path(kernel_id):
 			iopath="%sE%d" % (iopath,kernel_id-128)
 	return iopath		
 
+def build_pin_index():
+	"""
+	Fill the tables used to resolve connector names, MCU names and
+	Kernel IDs. Called on the first lookup and again if legacy_id changes
+	"""
+	global pin_index_legacy
+
+	name2kid.clear()
+	kid2mcuname.clear()
+	kid2pinnames.clear()
+	kid2path.clear()
+	kid2export.clear()
+
+	for port in range(5):
+		for line in range(32):
+			kernel_id=32+port*32+line
+			mcuname="P%s%d" % ("ABCDE"[port],line)
+			name2kid[mcuname]=kernel_id
+			kid2mcuname[kernel_id]=mcuname
+
+	connector2board={}
+	for board,connectors in pin_boards.items():
+		kid2pinnames[board]={}
+		for connector in connectors:
+			connector2board[connector]=board
+
+	for pinname,kernel_id in pin2kid.items():
+		name2kid[pinname]=kernel_id
+		#Skip the power and not connected pins
+		if kernel_id!=0:
+			#J4.7 is on connector J4, N2 on the N side of the Aria
+			if "." in pinname:
+				connector=pinname.split(".")[0]
+			else:
+				connector=pinname.rstrip("0123456789")
+			kid2pinnames[connector2board[connector]].setdefault(kernel_id,[]).append(pinname)
+
+	for kernel_id in set(name2kid.values()):
+		if kernel_id!=0:
+			kid2path[kernel_id]=gpio_sysfs_path(kernel_id)
+			if (legacy_id==True):
+				kid2export[kernel_id]=str(kernel_id)
+			else:
+				kid2export[kernel_id]=str(kernel_id-32)
+
+	pin_index_legacy=legacy_id
+
+def get_gpio_path(kernel_id):
+	if pin_index_legacy!=legacy_id:
+		build_pin_index()
+	try:
+		return kid2path[kernel_id]
+	except KeyError:
+		return gpio_sysfs_path(kernel_id)
+
+def get_export_id(kernel_id):
+	"""
+	Return the number to write in the sysfs export/unexport files
+	"""
+	if pin_index_legacy!=legacy_id:
+		build_pin_index()
+	try:
+		return kid2export[kernel_id]
+	except KeyError:
+		if (legacy_id==True):
+			return str(kernel_id)
+		else:
+			return str(kernel_id-32)
 
 def get_kernel_id(connector_name,pin_number):
 	return pinname2kernelid(connector_name + "." +pin_number)
 
 
+class ExportedLine():
+	"""
+	Cached export state of a line: direction and number of owners.
+	exported is False if the line was already exported by someone else
+	"""
+
+	def __init__(self):
+		self.direction=None
+		self.owners=0
+		self.exported=True
+
 def export(kernel_id):
 	global legacy_id
 
-	iopath=get_gpio_path(kernel_id)
-	if not os.path.exists(iopath): 
-		f = open('/sys/class/gpio/export','w')
-		if (legacy_id==True):
-			f.write(str(kernel_id))
+	if kernel_id in gpio_exports:
+		return
+
+	line=ExportedLine()
+	#The cdev backend requests the line in direction()
+	if gpio_backend!="cdev":
+		iopath=get_gpio_path(kernel_id)
+		if not os.path.exists(iopath): 
+			f = open('/sys/class/gpio/export','w')
+			f.write(get_export_id(kernel_id))
+			f.close()
 		else:
-			f.write(str(kernel_id-32))
-		f.close()
+			line.exported=False
+	gpio_exports[kernel_id]=line
 
 def unexport(kernel_id):
 	global legacy_id
 
+	gpio_exports.pop(kernel_id,None)
+
+	if gpio_backend=="cdev":
+		return cdev_release(kernel_id)
+
+	release_value_fd(kernel_id)
+
 	iopath=get_gpio_path(kernel_id)
 	if os.path.exists(iopath): 
 		f = open('/sys/class/gpio/unexport','w')
-		if (legacy_id==True):
-			f.write(str(kernel_id))
-		else:
-			f.write(str(kernel_id-32))
+		f.write(get_export_id(kernel_id))
 		f.close()
 
 def direction(kernel_id,direct):
-	iopath=get_gpio_path(kernel_id)
-	if os.path.exists(iopath): 
+	line=gpio_exports.get(kernel_id)
+	if line!=None and line.direction==direct:
+		return
+
+	if gpio_backend=="cdev":
+		cdev_direction(kernel_id,direct)
+	else:
+		iopath=get_gpio_path(kernel_id)
+		if not os.path.exists(iopath): 
+			return
 		f = open(iopath + '/direction','w')
 		f.write(direct)
 		f.close()
 
+	if line!=None:
+		line.direction=direct
+
+def request_lines(kernel_ids,direct):
+	"""
+	Export the lines and set their direction, skipping what is already
+	done, then add an owner to each of them. With the cdev backend the
+	new lines are requested with one ioctl per gpiochip. Raise IOError
+	if a line is already used with the other direction
+	"""
+	with gpio_exports_lock:
+		#A line in use keeps its configuration: check them all first
+		for kernel_id in kernel_ids:
+			line=gpio_exports.get(kernel_id)
+			if line!=None and line.owners>0 and line.direction!=None:
+				if (line.direction=="in")!=(direct=="in"):
+					raise IOError("GPIO %d is already in use with direction %s" % (kernel_id,line.direction))
+
+		if gpio_backend=="cdev":
+			new=[kernel_id for kernel_id in kernel_ids if kernel_id not in gpio_lines]
+			if new:
+				cdev_request(new,direct)
+				for kernel_id in new:
+					line=ExportedLine()
+					line.direction=direct
+					gpio_exports[kernel_id]=line
+
+		for kernel_id in kernel_ids:
+			line=gpio_exports.get(kernel_id)
+			if line==None or line.owners==0:
+				export(kernel_id)
+				direction(kernel_id,direct)
+			gpio_exports[kernel_id].owners+=1
+
+def request_line(kernel_id,direct):
+	request_lines([kernel_id],direct)
+
+def release_line(kernel_id):
+	"""
+	Drop an owner of a line. The last one stops its edge callbacks
+	and unexports it, unless it was exported by someone else
+	"""
+	with gpio_exports_lock:
+		line=gpio_exports.get(kernel_id)
+		if line==None:
+			return
+		line.owners-=1
+		if line.owners>0:
+			return
+
+		if edge_reactor!=None:
+			edge_reactor.unregister(kernel_id)
+		async_unwatch(kernel_id)
+		if line.exported:
+			unexport(kernel_id)
+		else:
+			del gpio_exports[kernel_id]
+			release_value_fd(kernel_id)
+
+def release_lines():
+	"""
+	Unexport all the lines exported by this process.
+	Called at exit if release_at_exit is True
+	"""
+	if not release_at_exit:
+		return
+
+	stop_edge_reactor()
+	with gpio_exports_lock:
+		for kernel_id,line in list(gpio_exports.items()):
+			if line.exported:
+				unexport(kernel_id)
+		gpio_exports.clear()
+
+atexit.register(release_lines)
+
+def get_value_fd(kernel_id):
+	"""
+	Return the cached file descriptor of the value file of a line,
+	opening it on the first use. Call it with gpio_fd_lock held
+	"""
+	fd=gpio_fd_cache.get(kernel_id)
+	if fd!=None:
+		gpio_fd_cache.move_to_end(kernel_id)
+		return fd
+
+	try:
+		fd=os.open(get_gpio_path(kernel_id) + '/value',os.O_RDWR)
+	except OSError:
+		return None
+
+	gpio_fd_cache[kernel_id]=fd
+	if len(gpio_fd_cache)>gpio_fd_cache_size:
+		os.close(gpio_fd_cache.popitem(last=False)[1])
+	return fd
+
+def release_value_fd(kernel_id):
+	with gpio_fd_lock:
+		fd=gpio_fd_cache.pop(kernel_id,None)
+		if fd!=None:
+			os.close(fd)
+
 def set_value(kernel_id,value):
-	iopath=get_gpio_path(kernel_id)
-	if os.path.exists(iopath): 
-		f = open(iopath + '/value','w')
-		f.write(str(value))
-		f.close()
+	if gpio_backend=="cdev":
+		return cdev_set_value(kernel_id,value)
+
+	level=gpio_levels.get(value)
+	if level==None:
+		level=str(value).encode()
+
+	with gpio_fd_lock:
+		fd=get_value_fd(kernel_id)
+		if fd==None:
+			return
+		try:
+			os.pwrite(fd,level,0)
+		except OSError:
+			#Stale fd, i.e. the line was unexported and exported again
+			#by someone else: reopen it once, do nothing if it is gone
+			os.close(gpio_fd_cache.pop(kernel_id))
+			fd=get_value_fd(kernel_id)
+			if fd!=None:
+				os.pwrite(fd,level,0)
 
 def get_value(kernel_id):
+	if gpio_backend=="cdev":
+		return cdev_get_value(kernel_id)
+
 	if kernel_id!=-1:
 		iopath=get_gpio_path(kernel_id)
 		if os.path.exists(iopath): 
@@ -878,6 +1145,9 @@ def get_value(kernel_id):
 			return int(a)
 
 def set_edge(kernel_id,value):
+	if gpio_backend=="cdev":
+		return cdev_set_edge(kernel_id,value)
+
 	iopath=get_gpio_path(kernel_id)
 	if os.path.exists(iopath): 
 		if value in ('none', 'rising', 'falling', 'both'):
@@ -914,12 +1184,14 @@ def soft_pwm_steps(kernel_id,value):
 		f.close()
 
 def existI2Cdevice(bus_id,i2c_address):
-	i2c_bus = smbus.SMBus(bus_id)
+	i2c_bus = get_i2c_bus(bus_id)
 	try:
 		i2c_bus.write_byte(i2c_address,0x00)
 		return True
 	except:
 		return False
+	finally:
+		release_i2c_bus(bus_id)
 
 def pinname2kernelid(pinname):
 	"""
@@ -927,6 +1199,13 @@ def pinname2kernelid(pinname):
 	or the board name
 	"""
 
+	if pin_index_legacy!=legacy_id:
+		build_pin_index()
+	try:
+		return name2kid[pinname]
+	except KeyError:
+		pass
+
 	offset=-1
 	if pinname[0:2]=="PA":
 		offset=32+0
@@ -944,6 +1223,38 @@ def pinname2kernelid(pinname):
 	else:	
 		return pin2kid[pinname]
 
+def kernelid2mcuname(kernel_id):
+	"""
+	Return the MCU name (i.e. PA23) of a Kernel ID
+	"""
+	if pin_index_legacy!=legacy_id:
+		build_pin_index()
+	return kid2mcuname.get(kernel_id)
+
+def kernelid2pinnames(kernel_id,board=None):
+	"""
+	Return the list of connector names wired to a Kernel ID on a
+	board of pin_boards. Without board return a dictionary of the
+	lists of all the boards using the line
+	"""
+	if pin_index_legacy!=legacy_id:
+		build_pin_index()
+	if board!=None:
+		return kid2pinnames[board].get(kernel_id,[])
+	return {board:pinnames[kernel_id] for board,pinnames in kid2pinnames.items() if kernel_id in pinnames}
+
+def mcuname2pinname(mcuname,board):
+	"""
+	Return the connector name of an MCU line on a board
+	(a key of pin_boards or mcuName2pinname)
+	"""
+	if board in mcuName2pinname:
+		return mcuName2pinname[board].get(mcuname)
+	pinnames=kernelid2pinnames(pinname2kernelid(mcuname),board)
+	if len(pinnames)==0:
+		return None
+	return pinnames[0]
+
 def readU8(bus,address,reg):
   result = bus.read_byte_data(address, reg)
   return result
@@ -959,31 +1270,2108 @@ def readS16(bus,address,register):
 	lo = readU8(bus,address,register+1)
 	return (hi << 8) + lo
 
-def readU16(bus,address,register):
-	hi = readU8(bus,address,register)
-	lo = readU8(bus,address,register+1)
-	return (hi << 8) + lo
+def readU16(bus,address,register):
+	hi = readU8(bus,address,register)
+	lo = readU8(bus,address,register+1)
+	return (hi << 8) + lo
+
+def write8(bus,address,reg,value):
+	bus.write_byte_data(address,reg,value)
+
+pwm_sysfs='/sys/class/pwm'
+
+def get_pwm_channels(chip=0):
+	iopath = '%s/pwmchip%d/npwm' % (pwm_sysfs, chip)
+	if os.path.exists(iopath): 
+		f = open(iopath,'r')
+		n = f.read()
+		f.close()
+		return int(n)
+	else:
+		return 0
+
+class PWM():
+	"""
+	PWM channel of a pwmchip (pwmchip0 by default). The period,
+	duty_cycle, polarity and enable files are kept open and written
+	with os.pwrite only when the value changes. period and pulse can
+	be None to leave them untouched
+	"""
+	channel_id=None
+	chippath=None
+	iopath=None
+	duty_fd=None
+	duty_value=None
+
+	def __init__(self, channel_id, period, pulse, chip=0):
+		self.channel_id = channel_id
+		self.chippath = '%s/pwmchip%d' % (pwm_sysfs, chip)
+		self.iopath = self.chippath + '/pwm' + str(channel_id)
+		self.fds = {}
+		self.values = {}
+		self.pwm_export()
+		if period != None:
+			self.pwm_period(period)
+		if pulse != None:
+			self.pwm_pulse(pulse)
+
+	def pwm_export(self):
+		if not os.path.exists(self.iopath): 
+			f = open(self.chippath + '/export','w')
+			f.write(str(self.channel_id))
+			f.close()
+
+	def pwm_unexport(self):
+		self.close()
+		if os.path.exists(self.iopath): 
+			f = open(self.chippath + '/unexport','w')
+			f.write(str(self.channel_id))
+			f.close()
+
+	def open_attr(self, name):
+		fd = self.fds.get(name)
+		if fd == None:
+			try:
+				fd = os.open(self.iopath + '/' + name, os.O_WRONLY)
+			except OSError:
+				return None
+			self.fds[name] = fd
+		return fd
+
+	def write_attr(self, name, value):
+		"""
+		Write value in a channel attribute unless it is already there
+		"""
+		if self.values.get(name) == value:
+			return
+		fd = self.open_attr(name)
+		if fd != None:
+			os.pwrite(fd, str(value).encode(), 0)
+			self.values[name] = value
+
+	def pwm_period(self, value):
+		self.write_attr('period', value)
+
+	def pwm_pulse(self, value):
+		if value == self.duty_value:
+			return
+		if self.duty_fd == None:
+			self.duty_fd = self.open_attr('duty_cycle')
+			if self.duty_fd == None:
+				return
+		os.pwrite(self.duty_fd, b"%d" % value, 0)
+		self.duty_value = value
+
+	def get_duty(self):
+		return self.duty_value
+
+	duty = property(get_duty, pwm_pulse)
+
+	def fade_to(self, target, duration, curve="linear"):
+		"""
+		Fade the duty cycle to target in duration seconds from the
+		fader thread. curve is a key of fade_curves. Return a
+		threading.Event set at the end of the fade
+		"""
+		return get_pwm_fader().fade([self], [target], duration, curve)[0]
+
+	def stop_fade(self):
+		if pwm_fader != None:
+			pwm_fader.stop(self)
+
+	def pwm_polarity(self, value):
+		self.write_attr('polarity', value)
+
+	def pwm_polarity_normal(self):
+		self.pwm_polarity("normal")
+
+	def pwm_polarity_inversed(self):
+		self.pwm_polarity("inversed")
+
+	def pwm_enable(self):
+		self.write_attr('enable', 1)
+
+	def pwm_disable(self):
+		self.write_attr('enable', 0)
+
+	def close(self):
+		"""
+		Close the attribute files kept open by the channel
+		"""
+		for fd in self.fds.values():
+			os.close(fd)
+		self.fds = {}
+		self.values = {}
+		self.duty_fd = None
+		self.duty_value = None
+
+class PWMBank():
+	"""
+	All the channels of a pwmchip. Channels are exported on first
+	use and their state is shadowed by the PWM objects, so bulk
+	updates write only the values that change:
+
+		leds=PWMBank()
+		leds.configure(period=1000000, duty=0, enable=1)
+		leds.set_duties(duties)
+	"""
+
+	def __init__(self, chip=0):
+		self.chip = chip
+		self.npwm = get_pwm_channels(chip)
+		self.channels = [None] * self.npwm
+
+	def channel(self, n):
+		"""
+		Return the PWM object of channel n, exporting it if needed
+		"""
+		pwm = self.channels[n]
+		if pwm == None:
+			pwm = PWM(n, None, None, self.chip)
+			self.channels[n] = pwm
+		return pwm
+
+	def __getitem__(self, n):
+		return self.channel(n)
+
+	def __len__(self):
+		return self.npwm
+
+	def configure(self, channels=None, period=None, duty=None, enable=None):
+		"""
+		Update period, duty cycle and enable state of many channels
+		(all by default) in one call. Each value is a single number
+		applied to all the channels or a sequence with one per channel
+		"""
+		if channels == None:
+			channels = range(self.npwm)
+
+		for i, n in enumerate(channels):
+			pwm = self.channel(n)
+			new_period = bank_value(period, i)
+			new_duty = bank_value(duty, i)
+
+			#The duty cycle can never exceed the period: lower it first,
+			#clamped to the new period if no new one is given
+			if new_period != None and pwm.duty_value != None and new_period < pwm.duty_value:
+				if new_duty == None or new_duty > new_period:
+					new_duty = new_period
+				pwm.pwm_pulse(new_duty)
+				pwm.pwm_period(new_period)
+			else:
+				if new_period != None:
+					pwm.pwm_period(new_period)
+				if new_duty != None:
+					pwm.pwm_pulse(new_duty)
+
+			new_enable = bank_value(enable, i)
+			if new_enable != None:
+				pwm.write_attr('enable', int(new_enable))
+
+	def set_duties(self, duties, first=0):
+		"""
+		Set the duty cycle of the channels first, first+1, ... from a
+		sequence (list, array or NumPy array), writing only the changes
+		"""
+		channels = self.channels
+		for n, value in enumerate(duties, first):
+			pwm = channels[n]
+			if pwm == None:
+				pwm = self.channel(n)
+			if value != pwm.duty_value:
+				pwm.pwm_pulse(int(value))
+
+	def get_duties(self):
+		"""
+		Return the shadowed duty cycles, None for unused channels
+		"""
+		return [pwm.duty_value if pwm != None else None for pwm in self.channels]
+
+	def enable_all(self):
+		self.configure(enable=1)
+
+	def disable_all(self):
+		self.configure(enable=0)
+
+	def close(self):
+		for pwm in self.channels:
+			if pwm != None:
+				pwm.close()
+		self.channels = [None] * self.npwm
+
+def bank_value(value, i):
+	"""
+	Return the value of the i-th channel from a number or a sequence
+	"""
+	if value == None or isinstance(value, numbers.Number):
+		return value
+	return value[i]
+
+## PWM FADER ###########################################################
+
+def curve_table(function,size=256):
+	"""
+	Sample a 0..1 -> 0..1 curve in a lookup table of size points
+	"""
+	return array.array('d',[function(i/float(size-1)) for i in range(size)])
+
+#Fade curves: fraction of the fade time -> fraction of the duty change
+fade_curves = {
+	"linear"   : curve_table(lambda x: x),
+	"gamma"    : curve_table(lambda x: x**2.2),
+	"ease"     : curve_table(lambda x: x*x*(3-2*x)),
+	"ease_in"  : curve_table(lambda x: x*x),
+	"ease_out" : curve_table(lambda x: 1-(1-x)*(1-x))
+}
+
+fade_tick=0.01
+pwm_fader=None
+pwm_fader_lock=threading.Lock()
+
+class Ramp():
+	"""
+	Fade of a PWM channel from start to target duty cycle
+	"""
+
+	def __init__(self,start,target,begin,duration,table):
+		self.start=start
+		self.delta=target-start
+		self.begin=begin
+		self.duration=duration
+		self.table=table
+		self.last=len(table)-1
+		self.done=threading.Event()
+
+class PWMFader():
+	"""
+	Single thread advancing the fades of all the PWM channels on
+	a shared time.monotonic() tick, so the callers never block
+	"""
+
+	def __init__(self,tick=0.01):
+		self.tick=tick
+		self.ramps={}
+		self.wakeup=threading.Condition()
+		self.thread=threading.Thread(target=self.run,name="ablib-fader",daemon=True)
+		self.thread.start()
+
+	def fade(self,channels,targets,duration,curve="linear"):
+		"""
+		Start the fades of channels to targets, all on the same tick.
+		Return a list of threading.Event set when each fade ends
+		"""
+		table=fade_curves[curve]
+		with self.wakeup:
+			begin=time.monotonic()
+			events=[]
+			for pwm,target in zip(channels,targets):
+				start=pwm.duty_value
+				if start==None:
+					start=0
+				ramp=Ramp(start,target,begin,duration,table)
+				old=self.ramps.get(pwm)
+				if old!=None:
+					old.done.set()
+				self.ramps[pwm]=ramp
+				events.append(ramp.done)
+			self.wakeup.notify()
+			return events
+
+	def stop(self,pwm):
+		with self.wakeup:
+			ramp=self.ramps.pop(pwm,None)
+			if ramp!=None:
+				ramp.done.set()
+
+	def run(self):
+		deadline=time.monotonic()
+		while True:
+			with self.wakeup:
+				while len(self.ramps)==0:
+					self.wakeup.wait()
+					deadline=time.monotonic()
+
+				now=time.monotonic()
+				for pwm,ramp in list(self.ramps.items()):
+					if ramp.duration>0:
+						progress=(now-ramp.begin)/ramp.duration
+					else:
+						progress=1.0
+					if progress>=1.0:
+						value=ramp.start+ramp.delta
+					else:
+						value=ramp.start+ramp.delta*ramp.table[int(progress*ramp.last)]
+					try:
+						pwm.pwm_pulse(int(value))
+					except OSError:
+						progress=1.0
+					if progress>=1.0:
+						del self.ramps[pwm]
+						ramp.done.set()
+
+				#Keep the tick grid, skipping the ticks already missed
+				deadline+=self.tick
+				if deadline<now:
+					deadline=now+self.tick
+				self.wakeup.wait(deadline-time.monotonic())
+
+def get_pwm_fader():
+	global pwm_fader
+
+	with pwm_fader_lock:
+		if pwm_fader==None:
+			pwm_fader=PWMFader(fade_tick)
+		return pwm_fader
+
+def fade_group(channels,targets,duration,curve="linear"):
+	"""
+	Fade many PWM channels together, i.e. all the leds to zero:
+
+		fade_group(leds,[0]*len(leds),2.0,"gamma")
+
+	Return a list of threading.Event set when each fade ends
+	"""
+	return get_pwm_fader().fade(channels,targets,duration,curve)
+
+
+
+## PWM WAVEFORM PLAYER #################################################
+
+class Waveform():
+	"""
+	Duty cycle pattern compiled once in an array('I') of samples
+	played at rate samples per second
+	"""
+
+	def __init__(self,samples,rate):
+		self.samples=array.array('I',samples)
+		self.rate=rate
+
+	def __len__(self):
+		return len(self.samples)
+
+	def duration(self):
+		return len(self.samples)/float(self.rate)
+
+def compile_waveform(function,duration,rate,scale):
+	"""
+	Sample function(t), t in seconds and result in 0..1, for duration
+	seconds at rate samples per second. scale is the duty cycle of 1,
+	usually the PWM period. I.e. a 2 seconds breathing at 50 Hz:
+
+		compile_waveform(lambda t: (1-math.cos(math.pi*t))/2,2,50,period)
+	"""
+	n=int(round(duration*rate))
+	return Waveform([int(function(i/float(rate))*scale) for i in range(n)],rate)
+
+class WaveformPlayer():
+	"""
+	Thread streaming a Waveform to one or more PWM channels. Samples
+	are taken from the absolute play time, so timing errors never
+	accumulate; ticks woken up more than one sample late are counted
+	"""
+
+	def __init__(self,channels):
+		self.channels=list(channels)
+		self.wakeup=threading.Condition()
+		self.track=None
+		self.fading=None
+		self.fade_begin=0
+		self.fade_time=0
+		self.ticks=0
+		self.late_ticks=0
+		self.max_lateness=0.0
+		self.done=threading.Event()
+		self.done.set()
+		self.thread=None
+		self.running=False
+
+	def play(self,waveform,loop=False,crossfade=0):
+		"""
+		Start playing waveform, forever if loop is True, otherwise
+		holding its last sample at the end. If another waveform is
+		playing it is crossfaded for crossfade seconds. Return a
+		threading.Event set when playing stops
+		"""
+		with self.wakeup:
+			now=time.monotonic()
+			if self.track!=None and crossfade>0:
+				self.fading=self.track
+				self.fade_begin=now
+				self.fade_time=crossfade
+			else:
+				self.fading=None
+			self.track=(waveform,now,loop)
+			self.done.clear()
+			#running is cleared by run() with the lock held, so a thread
+			#about to exit is never counted on to play the new track
+			if not self.running:
+				self.running=True
+				self.thread=threading.Thread(target=self.run,name="ablib-player",daemon=True)
+				self.thread.start()
+			self.wakeup.notify()
+		return self.done
+
+	def stop(self):
+		with self.wakeup:
+			self.track=None
+			self.fading=None
+			self.done.set()
+			self.wakeup.notify()
+
+	def sample(self,track,now):
+		"""
+		Return the (duty cycle,ended) pair of a track at time now
+		"""
+		(waveform,begin,loop)=track
+		samples=waveform.samples
+		i=int((now-begin)*waveform.rate)
+		if i>=len(samples):
+			if not loop:
+				return (samples[-1],True)
+			i%=len(samples)
+		return (samples[i],False)
+
+	def run(self):
+		with self.wakeup:
+			try:
+				while self.track!=None:
+					now=time.monotonic()
+					(value,ended)=self.sample(self.track,now)
+
+					if self.fading!=None:
+						mix=(now-self.fade_begin)/self.fade_time
+						if mix>=1.0:
+							self.fading=None
+						else:
+							(old,old_ended)=self.sample(self.fading,now)
+							value=int(old+(value-old)*mix)
+
+					#A failed write ends the track, like a fade
+					try:
+						for pwm in self.channels:
+							pwm.pwm_pulse(value)
+					except OSError:
+						self.fading=None
+						ended=True
+
+					if ended and self.fading==None:
+						self.track=None
+						break
+
+					(waveform,begin,loop)=self.track
+					period=1.0/waveform.rate
+					deadline=begin+(int((now-begin)*waveform.rate)+1)*period
+					self.wakeup.wait(max(0,deadline-time.monotonic()))
+
+					self.ticks+=1
+					lateness=time.monotonic()-deadline
+					if lateness>period:
+						self.late_ticks+=1
+					if lateness>self.max_lateness:
+						self.max_lateness=lateness
+			finally:
+				#Whatever stops the thread, the next play() starts a new one
+				self.track=None
+				self.fading=None
+				self.running=False
+				self.done.set()
+
+	def stats(self):
+		"""
+		Return the ticks played, the ticks late by more than one
+		sample and the maximum lateness in seconds
+		"""
+		return {
+			"ticks"        : self.ticks,
+			"late_ticks"   : self.late_ticks,
+			"max_lateness" : self.max_lateness
+		}
+
+## SERVO ###############################################################
+
+servo_tick=0.02
+servo_mover=None
+servo_mover_lock=threading.Lock()
+
+class Servo():
+	"""
+	Hobby servo on a PWM channel. Angles are turned in pulse widths
+	(ns) through a lookup table with one entry every resolution
+	degrees, linear between min_pulse and max_pulse or calibrated
+	with calibrate(). With slew (degrees per second) the moves are
+	limited by the servo mover thread:
+
+		pan=Servo(0,slew=60)
+		pan.calibrate([(0,550000),(90,1450000),(180,2400000)])
+		pan.angle=45
+	"""
+
+	def __init__(self,channel_id,chip=0,min_pulse=1000000,max_pulse=2000000,
+			angle_range=180,period=20000000,slew=None,resolution=0.5):
+		self.pwm=PWM(channel_id,period,None,chip)
+		self.angle_range=angle_range
+		self.resolution=resolution
+		self.slew=slew
+		self.position=None
+		self.target=None
+		self.calibrate([(0,min_pulse),(angle_range,max_pulse)])
+
+	def calibrate(self,points):
+		"""
+		Rebuild the lookup table from (angle,pulse) points measured on
+		the servo, interpolating linearly between them. At least two
+		points are needed, all with different angles
+		"""
+		points=sorted(points)
+		angles=set(angle for angle,pulse in points)
+		if len(points)<2 or len(angles)<len(points):
+			raise ValueError("Servo calibration needs at least two points with different angles")
+		size=int(round(self.angle_range/self.resolution))+1
+		table=array.array('I',bytes(4*size))
+		j=0
+		for i in range(size):
+			angle=i*self.resolution
+			while j<len(points)-2 and angle>points[j+1][0]:
+				j+=1
+			(a0,p0)=points[j]
+			(a1,p1)=points[j+1]
+			table[i]=int(round(p0+(p1-p0)*(angle-a0)/float(a1-a0)))
+		self.table=table
+		if self.position!=None:
+			self.write(self.position)
+
+	def pulse(self,angle):
+		"""
+		Return the pulse width (ns) of angle from the lookup table
+		"""
+		i=int(round(angle/self.resolution))
+		if i<0:
+			i=0
+		elif i>=len(self.table):
+			i=len(self.table)-1
+		return self.table[i]
+
+	def write(self,angle):
+		#pwm_pulse skips the pulse widths already written
+		self.position=angle
+		self.pwm.pwm_pulse(self.pulse(angle))
+
+	def set_angle(self,angle):
+		angle=min(max(angle,0),self.angle_range)
+		self.target=angle
+		if self.slew==None or self.position==None:
+			self.write(angle)
+			self.pwm.pwm_enable()
+		else:
+			get_servo_mover().move([self],[angle])
+
+	def get_angle(self):
+		return self.position
+
+	angle=property(get_angle,set_angle)
+
+	def detach(self):
+		"""
+		Stop the pulses, the servo can be moved by hand
+		"""
+		if servo_mover!=None:
+			servo_mover.stop(self)
+		self.pwm.pwm_disable()
+
+	def close(self):
+		self.detach()
+		self.pwm.close()
+
+class ServoGroup():
+	"""
+	Servos moved together, i.e. the legs of a robot. A move is
+	handed to the servo mover as one batch, so all the servos
+	start on the same tick
+	"""
+
+	def __init__(self,servos):
+		self.servos=list(servos)
+
+	def __len__(self):
+		return len(self.servos)
+
+	def move(self,angles):
+		"""
+		Move the servos to angles (a sequence, None to leave a servo
+		alone)
+		"""
+		slewed=[]
+		targets=[]
+		for servo,angle in zip(self.servos,angles):
+			if angle==None:
+				continue
+			angle=min(max(angle,0),servo.angle_range)
+			servo.target=angle
+			if servo.slew==None or servo.position==None:
+				servo.write(angle)
+				servo.pwm.pwm_enable()
+			else:
+				slewed.append(servo)
+				targets.append(angle)
+		if len(slewed)>0:
+			get_servo_mover().move(slewed,targets)
+
+	def get_angles(self):
+		return [servo.position for servo in self.servos]
+
+	def detach(self):
+		for servo in self.servos:
+			servo.detach()
+
+class ServoMover():
+	"""
+	Single thread stepping every moving servo toward its target at
+	no more than its slew rate, once per tick (a servo frame)
+	"""
+
+	def __init__(self,tick=0.02):
+		self.tick=tick
+		self.moving={}
+		self.wakeup=threading.Condition()
+		self.thread=threading.Thread(target=self.run,name="ablib-servo",daemon=True)
+		self.thread.start()
+
+	def move(self,servos,targets):
+		with self.wakeup:
+			for servo,target in zip(servos,targets):
+				self.moving[servo]=target
+			self.wakeup.notify()
+
+	def stop(self,servo):
+		with self.wakeup:
+			self.moving.pop(servo,None)
+
+	def run(self):
+		with self.wakeup:
+			last=time.monotonic()
+			while True:
+				while len(self.moving)==0:
+					self.wakeup.wait()
+					last=time.monotonic()-self.tick
+
+				now=time.monotonic()
+				elapsed=min(now-last,4*self.tick)
+				last=now
+				for servo,target in list(self.moving.items()):
+					step=servo.slew*elapsed
+					delta=target-servo.position
+					if abs(delta)<=step:
+						del self.moving[servo]
+					else:
+						target=servo.position+math.copysign(step,delta)
+					try:
+						servo.write(target)
+						servo.pwm.pwm_enable()
+					except OSError:
+						self.moving.pop(servo,None)
+
+				self.wakeup.wait(max(0,now+self.tick-time.monotonic()))
+
+def get_servo_mover():
+	global servo_mover
+
+	with servo_mover_lock:
+		if servo_mover==None:
+			servo_mover=ServoMover(servo_tick)
+		return servo_mover
+
+## SOFT PWM ############################################################
+
+soft_pwm_sysfs='/sys/class/soft_pwm'
+soft_pwm_generator=None
+soft_pwm_generator_lock=threading.Lock()
+
+class SoftPWM():
+	"""
+	Software PWM on a GPIO line, period and pulse in microseconds.
+	With the soft_pwm kernel module (/sys/class/soft_pwm) its files
+	are kept open and written only on changes, otherwise the line
+	is driven by the userspace SoftPWMGenerator thread
+	"""
+	kernel_id=None
+	owner=False
+
+	def __init__(self,pin,period,pulse):
+		if isinstance(pin,str):
+			self.kernel_id=pinname2kernelid(pin)
+		else:
+			self.kernel_id=pin
+		self.fds={}
+		self.values={}
+		self.period=0
+		self.pulse=0
+		self.steps=-1
+		self.fd=None
+		self.high=False
+
+		self.kernel=os.path.isdir(soft_pwm_sysfs)
+		if self.kernel:
+			soft_pwm_export(self.kernel_id)
+			self.iopath=soft_pwm_sysfs + '/pwm' + str(self.kernel_id)
+		else:
+			request_line(self.kernel_id,'low')
+			self.owner=True
+
+		try:
+			if not self.kernel and gpio_backend!="cdev":
+				self.fd=os.open(get_gpio_path(self.kernel_id) + '/value',os.O_RDWR)
+			self.set_period(period)
+			self.set_pulse(pulse)
+		except Exception:
+			#Do not keep the line requested until exit
+			self.close()
+			raise
+
+	def write_level(self,level):
+		"""
+		Drive the line to level, b"0" or b"1", through the held value
+		fd with sysfs or the line request with cdev
+		"""
+		if self.fd!=None:
+			os.pwrite(self.fd,level,0)
+		else:
+			cdev_set_value(self.kernel_id,level==b"1")
+
+	def write_attr(self,name,value):
+		if self.values.get(name)==value:
+			return
+		fd=self.fds.get(name)
+		if fd==None:
+			try:
+				fd=os.open(self.iopath + '/' + name,os.O_WRONLY)
+			except OSError:
+				return
+			self.fds[name]=fd
+		os.pwrite(fd,str(value).encode(),0)
+		self.values[name]=value
+
+	def set_period(self,value):
+		self.period=value
+		if self.kernel:
+			self.write_attr('period',value)
+		else:
+			get_soft_pwm_generator().update(self)
+
+	def set_pulse(self,value):
+		self.pulse=value
+		if self.kernel:
+			self.write_attr('pulse',value)
+		else:
+			get_soft_pwm_generator().update(self)
+
+	def set_steps(self,value):
+		"""
+		Emit value pulses and then stay low, -1 for no limit
+		"""
+		self.steps=value
+		if self.kernel:
+			self.write_attr('pulses',value)
+		else:
+			get_soft_pwm_generator().update(self)
+
+	def close(self):
+		for fd in self.fds.values():
+			os.close(fd)
+		self.fds={}
+		if not self.kernel and soft_pwm_generator!=None:
+			soft_pwm_generator.remove(self)
+		if self.fd!=None:
+			os.close(self.fd)
+			self.fd=None
+		if self.owner:
+			release_line(self.kernel_id)
+			self.owner=False
+
+class SoftPWMGenerator():
+	"""
+	Single timer thread driving many SoftPWM lines through their value
+	fds or line requests. Lines are grouped by period and every group has a precomputed
+	schedule of the edges of one period: all the lines go high at
+	offset 0 and each of them low at its pulse offset
+	"""
+
+	def __init__(self):
+		self.lines=[]
+		self.schedules={}
+		self.wakeup=threading.Condition()
+		self.thread=threading.Thread(target=self.run,name="ablib-softpwm",daemon=True)
+		self.thread.start()
+
+	def update(self,line):
+		with self.wakeup:
+			if line not in self.lines:
+				self.lines.append(line)
+			self.build()
+			self.wakeup.notify()
+
+	def remove(self,line):
+		with self.wakeup:
+			if line in self.lines:
+				self.lines.remove(line)
+				self.build()
+				self.wakeup.notify()
+
+	def build(self):
+		"""
+		Compute the edge schedule of every period:
+		a list of (offset in seconds,lines,level)
+		"""
+		groups={}
+		for line in self.lines:
+			if line.period<=0:
+				continue
+			if line.pulse<=0 or line.pulse>=line.period:
+				#Constant level, no edges to schedule
+				line.high=(line.pulse>0 and line.steps!=0)
+				line.write_level(gpio_levels[int(line.high)])
+				continue
+			groups.setdefault(line.period,[]).append(line)
+
+		self.schedules={}
+		for period,lines in groups.items():
+			falls={}
+			for line in lines:
+				falls.setdefault(line.pulse,[]).append(line)
+			edges=[(0.0,lines,b"1")]
+			for pulse in sorted(falls):
+				edges.append((pulse/1000000.0,falls[pulse],b"0"))
+			self.schedules[period]=edges
+
+	def run(self):
+		with self.wakeup:
+			while True:
+				while len(self.schedules)==0:
+					self.wakeup.wait()
+
+				#Heap of the next edge of every period group
+				schedules=self.schedules
+				begin=time.monotonic()
+				heap=[(begin,period,0) for period in schedules]
+				heapq.heapify(heap)
+				while schedules is self.schedules:
+					(deadline,period,i)=heap[0]
+					delay=deadline-time.monotonic()
+					if delay>0:
+						#Release the lock while waiting so updates get in
+						self.wakeup.wait(delay)
+						continue
+
+					(offset,lines,level)=schedules[period][i]
+					for line in lines:
+						if level==b"1":
+							if line.steps==0:
+								continue
+							if line.steps>0:
+								line.steps-=1
+						elif not line.high:
+							continue
+						line.write_level(level)
+						line.high=(level==b"1")
+
+					i+=1
+					if i==len(schedules[period]):
+						i=0
+						deadline+=period/1000000.0-offset
+					else:
+						deadline+=schedules[period][i][0]-offset
+					heapq.heapreplace(heap,(deadline,period,i))
+
+def get_soft_pwm_generator():
+	global soft_pwm_generator
+
+	with soft_pwm_generator_lock:
+		if soft_pwm_generator==None:
+			soft_pwm_generator=SoftPWMGenerator()
+		return soft_pwm_generator
+
+## I2C BUS POOL ########################################################
+
+i2c_buses={}
+i2c_buses_lock=threading.Lock()
+i2c_dev_path="/dev/i2c-%d"
+
+#Combined transfers (linux/i2c-dev.h), not limited to the 32 bytes
+#of the SMBus block reads
+I2C_RDWR=0x0707
+I2C_M_RD=0x0001
+
+class i2c_msg(ctypes.Structure):
+	_fields_ = [
+		("addr", ctypes.c_uint16),
+		("flags", ctypes.c_uint16),
+		("len", ctypes.c_uint16),
+		("buf", ctypes.c_void_p),
+	]
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+	_fields_ = [
+		("msgs", ctypes.POINTER(i2c_msg)),
+		("nmsgs", ctypes.c_uint32),
+	]
+
+def i2c_ioctl(fd,request,arg):
+	"""
+	Issue an i2c-dev ioctl. Replace it with a fake to exercise
+	the combined transfers without the real hardware
+	"""
+	return fcntl.ioctl(fd,request,arg,True)
+
+class I2CBus():
+	"""
+	smbus.SMBus handle shared by all the users of an I2C bus. Every
+	transfer takes the bus lock; multi-transfer transactions (i.e.
+	read-modify-write) hold it with:
+
+		with bus:
+			value=bus.read_byte(address)
+			bus.write_byte(address,value|mask)
+	"""
+
+	def __init__(self,bus_id):
+		self.bus_id=bus_id
+		self.bus=smbus.SMBus(bus_id)
+		self.lock=threading.RLock()
+		self.refs=0
+		self.fd=None
+
+	def __enter__(self):
+		self.lock.acquire()
+		return self
+
+	def __exit__(self,*exc):
+		self.lock.release()
+
+	def write_quick(self,address):
+		with self.lock:
+			return self.bus.write_quick(address)
+
+	def read_byte(self,address):
+		with self.lock:
+			return self.bus.read_byte(address)
+
+	def write_byte(self,address,value):
+		with self.lock:
+			return self.bus.write_byte(address,value)
+
+	def read_byte_data(self,address,register):
+		with self.lock:
+			return self.bus.read_byte_data(address,register)
+
+	def write_byte_data(self,address,register,value):
+		with self.lock:
+			return self.bus.write_byte_data(address,register,value)
+
+	def read_word_data(self,address,register):
+		with self.lock:
+			return self.bus.read_word_data(address,register)
+
+	def write_word_data(self,address,register,value):
+		with self.lock:
+			return self.bus.write_word_data(address,register,value)
+
+	def read_i2c_block_data(self,address,register,length=32):
+		with self.lock:
+			return self.bus.read_i2c_block_data(address,register,length)
+
+	def write_i2c_block_data(self,address,register,data):
+		with self.lock:
+			return self.bus.write_i2c_block_data(address,register,data)
+
+	def read_block(self,address,register,length):
+		"""
+		Read length bytes from register in one combined transfer
+		(register write, repeated start, read) of any size.
+		Return them as a bytearray
+		"""
+		data=bytearray(length)
+		pointer=(ctypes.c_uint8*1)(register)
+		buf=(ctypes.c_uint8*length).from_buffer(data)
+		msgs=(i2c_msg*2)(
+			i2c_msg(address,0,1,ctypes.addressof(pointer)),
+			i2c_msg(address,I2C_M_RD,length,ctypes.addressof(buf))
+		)
+		rdwr=i2c_rdwr_ioctl_data(msgs,2)
+		with self.lock:
+			if self.fd==None:
+				self.fd=os.open(i2c_dev_path % self.bus_id,os.O_RDWR)
+			i2c_ioctl(self.fd,I2C_RDWR,rdwr)
+		del buf
+		return data
+
+	def close(self):
+		with self.lock:
+			if self.fd!=None:
+				os.close(self.fd)
+				self.fd=None
+			self.bus.close()
+
+def get_i2c_bus(bus_id=0):
+	"""
+	Return the shared I2CBus of bus_id, opening it on first use.
+	Every call must be paired with a release_i2c_bus()
+	"""
+	with i2c_buses_lock:
+		bus=i2c_buses.get(bus_id)
+		if bus==None:
+			bus=I2CBus(bus_id)
+			i2c_buses[bus_id]=bus
+		bus.refs+=1
+		return bus
+
+def release_i2c_bus(bus_id):
+	"""
+	Drop a reference to the bus, closing it with the last one
+	"""
+	with i2c_buses_lock:
+		bus=i2c_buses.get(bus_id)
+		if bus==None:
+			return
+		bus.refs-=1
+		if bus.refs<=0:
+			del i2c_buses[bus_id]
+			bus.close()
+
+## GPIO CHARACTER DEVICE ###############################################
+
+# GPIO v2 uAPI (linux/gpio.h) used when the "cdev" backend is selected
+# with set_gpio_backend(). Each AT91 PIO bank is a 32 lines gpiochip so
+# the Kernel ID 32+bank*32+n is the line n of /dev/gpiochip<bank>
+
+GPIO_V2_LINES_MAX = 64
+GPIO_V2_LINE_NUM_ATTRS_MAX = 10
+
+GPIO_V2_LINE_FLAG_INPUT = 1<<2
+GPIO_V2_LINE_FLAG_OUTPUT = 1<<3
+GPIO_V2_LINE_FLAG_EDGE_RISING = 1<<4
+GPIO_V2_LINE_FLAG_EDGE_FALLING = 1<<5
+
+GPIO_V2_LINE_ATTR_ID_FLAGS = 1
+GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES = 2
+GPIO_V2_LINE_ATTR_ID_DEBOUNCE = 3
+
+GPIO_V2_GET_LINE_IOCTL = 0xC250B407
+GPIO_V2_LINE_SET_CONFIG_IOCTL = 0xC110B40D
+GPIO_V2_LINE_GET_VALUES_IOCTL = 0xC010B40E
+GPIO_V2_LINE_SET_VALUES_IOCTL = 0xC010B40F
+
+GPIO_V2_LINE_EVENT_RISING_EDGE = 1
+GPIO_V2_LINE_EVENT_FALLING_EDGE = 2
+GPIO_V2_LINE_EVENT_SIZE = 48
+
+class gpio_v2_line_attribute(ctypes.Structure):
+	# value is the flags/values/debounce_period_us union
+	_fields_ = [
+		("id", ctypes.c_uint32),
+		("padding", ctypes.c_uint32),
+		("value", ctypes.c_uint64),
+	]
+
+class gpio_v2_line_config_attribute(ctypes.Structure):
+	_fields_ = [
+		("attr", gpio_v2_line_attribute),
+		("mask", ctypes.c_uint64),
+	]
+
+class gpio_v2_line_config(ctypes.Structure):
+	_fields_ = [
+		("flags", ctypes.c_uint64),
+		("num_attrs", ctypes.c_uint32),
+		("padding", ctypes.c_uint32*5),
+		("attrs", gpio_v2_line_config_attribute*GPIO_V2_LINE_NUM_ATTRS_MAX),
+	]
+
+class gpio_v2_line_request(ctypes.Structure):
+	_fields_ = [
+		("offsets", ctypes.c_uint32*GPIO_V2_LINES_MAX),
+		("consumer", ctypes.c_char*32),
+		("config", gpio_v2_line_config),
+		("num_lines", ctypes.c_uint32),
+		("event_buffer_size", ctypes.c_uint32),
+		("padding", ctypes.c_uint32*5),
+		("fd", ctypes.c_int32),
+	]
+
+class gpio_v2_line_values(ctypes.Structure):
+	_fields_ = [
+		("bits", ctypes.c_uint64),
+		("mask", ctypes.c_uint64),
+	]
+
+gpio_backend="sysfs"
+gpiochip_path="/dev/gpiochip%d"
+gpiochip_lines=32
+gpiochip_fds={}
+
+#Kernel ID -> (GpioLines,bit) of the lines requested by the cdev backend
+gpio_lines={}
+#Released lines still held by a request with other lines in use
+gpio_released={}
+gpio_lines_lock=threading.Lock()
+
+gpio_direction_flags = {
+	"in"   : GPIO_V2_LINE_FLAG_INPUT,
+	"out"  : GPIO_V2_LINE_FLAG_OUTPUT,
+	"low"  : GPIO_V2_LINE_FLAG_OUTPUT,
+	"high" : GPIO_V2_LINE_FLAG_OUTPUT
+}
+
+gpio_edge_flags = {
+	"none"    : 0,
+	"rising"  : GPIO_V2_LINE_FLAG_EDGE_RISING,
+	"falling" : GPIO_V2_LINE_FLAG_EDGE_FALLING,
+	"both"    : GPIO_V2_LINE_FLAG_EDGE_RISING|GPIO_V2_LINE_FLAG_EDGE_FALLING
+}
+
+def gpio_ioctl(fd,request,arg):
+	"""
+	Issue a GPIO character device ioctl. Replace it with a fake
+	to exercise the cdev backend without the real hardware
+	"""
+	return fcntl.ioctl(fd,request,arg,True)
+
+def get_gpiochip_fd(chip):
+	fd=gpiochip_fds.get(chip)
+	if fd==None:
+		fd=os.open(gpiochip_path % chip,os.O_RDWR|os.O_CLOEXEC)
+		gpiochip_fds[chip]=fd
+	return fd
+
+def kernelid2line(kernel_id):
+	"""
+	Return the (gpiochip number,line offset) pair of a Kernel ID
+	"""
+	return divmod(kernel_id-32,gpiochip_lines)
+
+def set_gpio_backend(name="auto"):
+	"""
+	Select the backend used by export(), direction(), set_value(),
+	get_value() and set_edge(): "sysfs", "cdev" (/dev/gpiochipN) or
+	"auto". Fall back to sysfs if no gpiochip can be opened.
+	Return the name of the selected backend
+	"""
+	global gpio_backend
+
+	if name in ("cdev","auto"):
+		try:
+			get_gpiochip_fd(0)
+			name="cdev"
+		except OSError:
+			name="sysfs"
+
+	gpio_backend=name
+	return name
+
+class GpioLines():
+	"""
+	Lines of a gpiochip requested with a single ioctl. Bit n of the
+	values read and written refers to the line offsets[n]
+	"""
+
+	def __init__(self,chip,offsets,flags,values=0,consumer="ablib"):
+		self.chip=chip
+		self.offsets=list(offsets)
+		self.flags=[flags]*len(self.offsets)
+		self.values=values
+		self.requested=(1<<len(self.offsets))-1
+		self.lock=threading.Lock()
+		self.buf=gpio_v2_line_values()
+
+		req=gpio_v2_line_request()
+		for i,offset in enumerate(self.offsets):
+			req.offsets[i]=offset
+		req.num_lines=len(self.offsets)
+		req.consumer=consumer.encode()
+		self.fill_config(req.config)
+		gpio_ioctl(get_gpiochip_fd(chip),GPIO_V2_GET_LINE_IOCTL,req)
+		self.fd=req.fd
+
+	def fill_config(self,config):
+		"""
+		Describe the per line flags and output values as the default
+		flags plus one attribute for every other set of flags
+		"""
+		config.flags=self.flags[0]
+		attrs=[]
+		for flags in set(self.flags):
+			if flags!=config.flags:
+				attrs.append((GPIO_V2_LINE_ATTR_ID_FLAGS,flags,self.mask_of(flags)))
+
+		outputs=0
+		for i,flags in enumerate(self.flags):
+			if flags&GPIO_V2_LINE_FLAG_OUTPUT:
+				outputs|=1<<i
+		if outputs:
+			attrs.append((GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES,self.values,outputs))
+
+		for i,(attr_id,value,mask) in enumerate(attrs):
+			config.attrs[i].attr.id=attr_id
+			config.attrs[i].attr.value=value
+			config.attrs[i].mask=mask
+		config.num_attrs=len(attrs)
+
+	def mask_of(self,flags):
+		mask=0
+		for i,line_flags in enumerate(self.flags):
+			if line_flags==flags:
+				mask|=1<<i
+		return mask
+
+	def set_config(self,mask,flags,values=None):
+		"""
+		Change the flags of the lines in mask, with a single ioctl
+		"""
+		with self.lock:
+			for i in range(len(self.offsets)):
+				if mask&(1<<i):
+					self.flags[i]=flags
+			if values!=None:
+				self.values=(self.values&~mask)|(values&mask)
+			config=gpio_v2_line_config()
+			self.fill_config(config)
+			gpio_ioctl(self.fd,GPIO_V2_LINE_SET_CONFIG_IOCTL,config)
+
+	def get_values(self,mask=-1):
+		with self.lock:
+			self.buf.bits=0
+			self.buf.mask=mask&self.requested
+			gpio_ioctl(self.fd,GPIO_V2_LINE_GET_VALUES_IOCTL,self.buf)
+			return self.buf.bits
+
+	def set_values(self,bits,mask=-1):
+		with self.lock:
+			self.buf.bits=bits
+			self.buf.mask=mask&self.requested
+			gpio_ioctl(self.fd,GPIO_V2_LINE_SET_VALUES_IOCTL,self.buf)
+			self.values=(self.values&~mask)|(bits&mask)
+
+	def release(self,mask):
+		"""
+		Forget the lines in mask and close the request when none is
+		left. The kernel keeps the lines of a live request held, so
+		they are turned into plain inputs until requested again
+		"""
+		self.requested&=~mask
+		if self.requested==0:
+			self.close()
+		else:
+			self.set_config(mask,GPIO_V2_LINE_FLAG_INPUT)
+
+	def reuse(self,mask,flags,values=0):
+		"""
+		Take back released lines of the request with new flags
+		"""
+		self.requested|=mask
+		self.set_config(mask,flags,values)
+
+	def close(self):
+		if self.fd!=None:
+			os.close(self.fd)
+			self.fd=None
+
+	def fileno(self):
+		return self.fd
+
+def cdev_request(kernel_ids,direct="in"):
+	"""
+	Request the lines in kernel_ids not yet requested, with one
+	ioctl for every gpiochip, and return their (GpioLines,bit) pairs
+	"""
+	flags=gpio_direction_flags[direct]
+	values=0
+	if direct=="high":
+		values=-1
+
+	with gpio_lines_lock:
+		chips={}
+		for kernel_id in kernel_ids:
+			if kernel_id in gpio_lines:
+				continue
+			line=gpio_released.pop(kernel_id,None)
+			if line!=None:
+				(req,bit)=line
+				req.reuse(1<<bit,flags,values&(1<<bit))
+				gpio_lines[kernel_id]=line
+				continue
+			chip,offset=kernelid2line(kernel_id)
+			chips.setdefault(chip,[]).append((kernel_id,offset))
+
+		for chip,lines in chips.items():
+			for first in range(0,len(lines),GPIO_V2_LINES_MAX):
+				block=lines[first:first+GPIO_V2_LINES_MAX]
+				req=GpioLines(chip,[offset for kernel_id,offset in block],flags,values&((1<<len(block))-1))
+				for bit,(kernel_id,offset) in enumerate(block):
+					gpio_lines[kernel_id]=(req,bit)
+
+		return [gpio_lines[kernel_id] for kernel_id in kernel_ids]
+
+def cdev_release(kernel_id):
+	with gpio_lines_lock:
+		line=gpio_lines.pop(kernel_id,None)
+		if line!=None:
+			(req,bit)=line
+			req.release(1<<bit)
+			if req.fd!=None:
+				gpio_released[kernel_id]=line
+			else:
+				for other,(other_req,other_bit) in list(gpio_released.items()):
+					if other_req is req:
+						del gpio_released[other]
+
+def cdev_direction(kernel_id,direct):
+	line=gpio_lines.get(kernel_id)
+	if line==None:
+		cdev_request([kernel_id],direct)
+		return
+
+	(req,bit)=line
+	values=0
+	if direct=="high":
+		values=1<<bit
+	req.set_config(1<<bit,gpio_direction_flags[direct],values)
+
+def cdev_set_edge(kernel_id,value):
+	line=gpio_lines.get(kernel_id)
+	if line!=None:
+		(req,bit)=line
+		req.set_config(1<<bit,GPIO_V2_LINE_FLAG_INPUT|gpio_edge_flags[value])
+
+def cdev_set_value(kernel_id,value):
+	line=gpio_lines.get(kernel_id)
+	if line!=None:
+		(req,bit)=line
+		if value and value!="0":
+			req.set_values(1<<bit,1<<bit)
+		else:
+			req.set_values(0,1<<bit)
+
+def cdev_get_value(kernel_id):
+	line=gpio_lines.get(kernel_id)
+	if line!=None:
+		(req,bit)=line
+		return (req.get_values(1<<bit)>>bit)&1
+
+## EDGE REACTOR ########################################################
+
+edge_workers=4
+edge_reactor=None
+edge_reactor_lock=threading.Lock()
+
+#Edge seen on a line: level after the edge, timestamp in
+#nanoseconds of time.monotonic_ns()
+EdgeEvent = collections.namedtuple("EdgeEvent","kernel_id level timestamp")
+
+class EdgeQueue():
+	"""
+	Bounded ring buffer of edge events preallocated as arrays of
+	Kernel IDs, levels and time.monotonic_ns() timestamps. Events are
+	pushed by the edge reactor at the poll site and drained in batches
+	by the consumers. When the buffer is full new events are dropped
+	and counted
+	"""
+
+	def __init__(self,size=1024):
+		self.size=size
+		self.kernel_ids=array.array('H',[0])*size
+		self.levels=array.array('B',[0])*size
+		self.timestamps=array.array('Q',[0])*size
+		self.head=0
+		self.count=0
+		self.pushed=0
+		self.dropped=0
+		self.peak=0
+		self.lock=threading.Lock()
+		self.not_empty=threading.Condition(self.lock)
+
+	def push(self,kernel_id,level,timestamp):
+		with self.lock:
+			if self.count==self.size:
+				self.dropped+=1
+				return False
+
+			i=(self.head+self.count)%self.size
+			self.kernel_ids[i]=kernel_id
+			self.levels[i]=level
+			self.timestamps[i]=timestamp
+			self.count+=1
+			self.pushed+=1
+			if self.count>self.peak:
+				self.peak=self.count
+			self.not_empty.notify()
+			return True
+
+	def drain(self,max_events=0,timeout=0):
+		"""
+		Remove and return up to max_events (0 for all) queued events as
+		a list of EdgeEvent. On an empty queue wait up to timeout seconds,
+		forever with timeout=None
+		"""
+		with self.lock:
+			if self.count==0 and timeout!=0:
+				self.not_empty.wait_for(lambda: self.count>0,timeout)
+
+			n=self.count
+			if max_events>0 and max_events<n:
+				n=max_events
+
+			events=[]
+			i=self.head
+			for j in range(n):
+				events.append(EdgeEvent(self.kernel_ids[i],self.levels[i],self.timestamps[i]))
+				i+=1
+				if i==self.size:
+					i=0
+			self.head=i
+			self.count-=n
+			return events
+
+	def __len__(self):
+		return self.count
+
+	def stats(self):
+		"""
+		Return the pushed, dropped, pending and peak event counters
+		"""
+		with self.lock:
+			return {
+				"pushed"  : self.pushed,
+				"dropped" : self.dropped,
+				"pending" : self.count,
+				"peak"    : self.peak
+			}
+
+class TimerWheel():
+	"""
+	Hashed timer wheel: deadlines in time.monotonic_ns() are rounded
+	to ticks and kept in a ring of slots, so scheduling and expiring
+	cost O(1) whatever the number of timers. Timers are cancelled
+	lazily by the owner ignoring stale deadlines
+	"""
+
+	def __init__(self,tick=0.001,slots=256):
+		self.tick=int(tick*1e9)
+		self.slots=[[] for i in range(slots)]
+		self.current=time.monotonic_ns()//self.tick
+		self.count=0
+		#Min-heap of the ticks of the pending timers
+		self.ticks=[]
+
+	def schedule(self,deadline,item):
+		tick=-(-deadline//self.tick)
+		if tick<=self.current:
+			tick=self.current+1
+		self.slots[tick%len(self.slots)].append((tick,deadline,item))
+		heapq.heappush(self.ticks,tick)
+		self.count+=1
+
+	def expire(self,now):
+		"""
+		Remove and return the (deadline,item) pairs due by now
+		"""
+		expired=[]
+		now_tick=now//self.tick
+		if self.count==0 or now_tick<=self.current:
+			self.current=max(self.current,now_tick)
+			return expired
+
+		ticks=min(now_tick-self.current,len(self.slots))
+		for i in range(1,ticks+1):
+			slot=self.slots[(self.current+i)%len(self.slots)]
+			if len(slot)==0:
+				continue
+			pending=[]
+			for timer in slot:
+				if timer[0]<=now_tick:
+					expired.append((timer[1],timer[2]))
+				else:
+					pending.append(timer)
+			slot[:]=pending
+		self.count-=len(expired)
+		while self.ticks and self.ticks[0]<=now_tick:
+			heapq.heappop(self.ticks)
+		self.current=now_tick
+		return expired
+
+	def timeout(self):
+		"""
+		Return the seconds to wait for the earliest timer, -1 without
+		timers
+		"""
+		if self.count==0:
+			return -1
+		return max(0,(self.ticks[0]*self.tick-time.monotonic_ns())/1e9)
+
+class EdgeLine():
+	"""
+	Line registered in an EdgePoller and its debounce state
+	"""
+
+	def __init__(self,kernel_id,callback=None,queue=None):
+		self.kernel_id=kernel_id
+		self.fd=None
+		self.callback=callback
+		self.queue=queue
+		self.edge=None
+		self.count=0
+		#Callbacks reported and not run yet
+		self.pending=0
+
+		#Debounce state, times in nanoseconds
+		self.stabletime=0
+		self.glitchtime=0
+		self.level=0
+		self.raw=0
+		self.raw_time=0
+		self.candidate=0
+		self.deadline=0
+		self.previous=(0,0)
+		self.bounces=0
+		self.glitches=0
+
+	def configure(self,callback,queue,edge,debouncingtime,glitchtime):
+		self.callback=callback
+		self.queue=queue
+		self.edge=edge
+		self.stabletime=int(debouncingtime*1000000)
+		self.glitchtime=int(glitchtime*1000000)
+		self.raw=self.level
+		self.candidate=self.level
+
+class EdgePoller():
+	"""
+	epoll set with the sysfs value files (EPOLLPRI) or the cdev line
+	requests (EPOLLIN) of the watched lines
+	"""
+
+	def __init__(self):
+		self.lines={}
+		self.sysfs_fds={}
+		self.cdev_fds={}
+		self.epoll=select.epoll()
+		self.errors=0
+		self.last_error=None
+
+	def add(self,line):
+		kernel_id=line.kernel_id
+		if gpio_backend=="cdev":
+			(req,bit)=gpio_lines[kernel_id]
+			line.fd=req.fd
+			offsets=self.cdev_fds.get(line.fd)
+			if offsets==None:
+				offsets={}
+				self.cdev_fds[line.fd]=offsets
+				self.epoll.register(line.fd,select.EPOLLIN)
+			offsets[req.offsets[bit]]=kernel_id
+			line.level=(req.get_values(1<<bit)>>bit)&1
+		else:
+			line.fd=os.open(get_gpio_path(kernel_id) + '/value',os.O_RDONLY)
+			#Read the value once, otherwise the first poll returns at once
+			line.level=int(os.pread(line.fd,1,0)==b"1")
+			self.sysfs_fds[line.fd]=kernel_id
+			self.epoll.register(line.fd,select.EPOLLPRI|select.EPOLLERR)
+
+		self.lines[kernel_id]=line
+
+	def remove(self,kernel_id):
+		line=self.lines.pop(kernel_id,None)
+		if line==None:
+			return None
+
+		if line.fd in self.sysfs_fds:
+			del self.sysfs_fds[line.fd]
+			self.epoll.unregister(line.fd)
+			os.close(line.fd)
+		else:
+			offsets=self.cdev_fds[line.fd]
+			for offset,offset_kernel_id in list(offsets.items()):
+				if offset_kernel_id==kernel_id:
+					del offsets[offset]
+			#The request fd belongs to the cdev backend
+			if len(offsets)==0:
+				del self.cdev_fds[line.fd]
+				try:
+					self.epoll.unregister(line.fd)
+				except (OSError,ValueError):
+					pass
+		return line
+
+	def read_events(self,events):
+		"""
+		Turn the (fd,mask) pairs returned by epoll.poll() into
+		a list of EdgeEvent
+		"""
+		edges=[]
+		for fd,mask in events:
+			try:
+				self.read_fd(fd,edges)
+			except OSError as err:
+				self.fd_error(fd,err)
+		return edges
+
+	def read_fd(self,fd,edges):
+		kernel_id=self.sysfs_fds.get(fd)
+		if kernel_id!=None:
+			timestamp=time.monotonic_ns()
+			level=int(os.pread(fd,1,0)==b"1")
+			edges.append(EdgeEvent(kernel_id,level,timestamp))
+			return
+
+		offsets=self.cdev_fds.get(fd)
+		if offsets!=None:
+			data=os.read(fd,GPIO_V2_LINE_EVENT_SIZE*16)
+			for start in range(0,len(data),GPIO_V2_LINE_EVENT_SIZE):
+				(timestamp,event_id,offset)=struct.unpack_from("<QII",data,start)
+				kernel_id=offsets.get(offset)
+				if kernel_id!=None:
+					level=int(event_id==GPIO_V2_LINE_EVENT_RISING_EDGE)
+					edges.append(EdgeEvent(kernel_id,level,timestamp))
+
+	def fd_error(self,fd,err):
+		"""
+		Count a read error and stop watching the lines of the fd,
+		i.e. a line unexported by another process
+		"""
+		self.errors+=1
+		self.last_error=err
+		if fd in self.sysfs_fds:
+			kernel_ids=[self.sysfs_fds[fd]]
+		else:
+			kernel_ids=list(self.cdev_fds.get(fd,{}).values())
+		for kernel_id in kernel_ids:
+			try:
+				self.remove(kernel_id)
+			except (OSError,ValueError):
+				pass
+
+	def close(self):
+		for kernel_id in list(self.lines):
+			self.remove(kernel_id)
+		self.epoll.close()
+
+class EdgeReactor(EdgePoller):
+	"""
+	Single thread waiting in one epoll set for the edges of all the
+	registered lines. Callbacks run on a pool of worker threads, so
+	a slow callback does not delay the other lines. The callbacks of
+	the same line still run one at a time, in the order of its edges.
+
+	Debounced lines go through a state machine clocked by a timer
+	wheel: a new level is reported only once it has been stable for
+	debouncingtime ms, and excursions shorter than glitchtime ms do
+	not restart that wait. Bounces never wake a callback
+	"""
+
+	def __init__(self,workers=4):
+		EdgePoller.__init__(self)
+		self.lock=threading.Lock()
+		self.wheel=TimerWheel()
+		self.pool=concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+		(self.wake_r,self.wake_w)=os.pipe()
+		self.epoll.register(self.wake_r,select.EPOLLIN)
+		self.running=True
+		self.thread=threading.Thread(target=self.run,name="ablib-edges",daemon=True)
+		self.thread.start()
+
+	def register(self,kernel_id,callback,queue=None,edge="both",debouncingtime=0,glitchtime=0):
+		"""
+		Call callback() on every edge of a line and/or push its edges
+		in an EdgeQueue. The edge type must be already set with
+		set_edge(), to "both" for the debounced lines
+		"""
+		with self.lock:
+			line=self.lines.get(kernel_id)
+			if line==None:
+				line=EdgeLine(kernel_id)
+				self.add(line)
+			line.configure(callback,queue,edge,debouncingtime,glitchtime)
+
+	def unregister(self,kernel_id):
+		with self.lock:
+			self.remove(kernel_id)
+
+	def run(self):
+		while self.running:
+			events=self.epoll.poll(self.wheel.timeout())
+			with self.lock:
+				#An error is counted and never stops the thread,
+				#or all the lines would lose their edges
+				for event in self.read_events(events):
+					try:
+						self.dispatch(event)
+					except Exception as err:
+						self.errors+=1
+						self.last_error=err
+				for deadline,line in self.wheel.expire(time.monotonic_ns()):
+					try:
+						self.settle(line,deadline)
+					except Exception as err:
+						self.errors+=1
+						self.last_error=err
+
+	def read_events(self,events):
+		for fd,mask in events:
+			if fd==self.wake_r:
+				os.read(fd,64)
+		return EdgePoller.read_events(self,events)
+
+	def dispatch(self,event):
+		line=self.lines.get(event.kernel_id)
+		if line==None:
+			return
+		line.count+=1
+
+		if line.stabletime==0 and line.glitchtime==0:
+			line.level=event.level
+			self.report(line,event)
+			return
+
+		if event.level==line.raw:
+			return
+		line.raw=event.level
+
+		if event.level==line.previous[0] and event.timestamp-line.raw_time<line.glitchtime:
+			#Short excursion: go on waiting for the previous candidate
+			(line.candidate,line.deadline)=line.previous
+			line.glitches+=1
+		else:
+			#Back to the reported level before the deadline
+			if event.level==line.level:
+				line.bounces+=1
+			line.previous=(line.candidate,line.deadline)
+			line.candidate=event.level
+			line.deadline=event.timestamp+line.stabletime
+		line.raw_time=event.timestamp
+
+		if line.candidate!=line.level:
+			self.wheel.schedule(line.deadline,line)
+
+	def settle(self,line,deadline):
+		"""
+		Timer of a debounced line: report the candidate level if it
+		has been stable until its deadline
+		"""
+		if deadline!=line.deadline or self.lines.get(line.kernel_id)!=line:
+			return
+		if line.candidate==line.level:
+			return
+		line.level=line.candidate
+		self.report(line,EdgeEvent(line.kernel_id,line.level,deadline-line.stabletime))
+
+	def report(self,line,event):
+		if line.edge=="rising" and event.level==0:
+			return
+		if line.edge=="falling" and event.level==1:
+			return
+		if line.queue!=None:
+			line.queue.push(event.kernel_id,event.level,event.timestamp)
+		if line.callback!=None:
+			#Only one worker at a time runs the callbacks of a line
+			line.pending+=1
+			if line.pending==1:
+				try:
+					self.pool.submit(self.run_callbacks,line)
+				except Exception:
+					line.pending=0
+					raise
+
+	def run_callbacks(self,line):
+		while True:
+			callback=line.callback
+			try:
+				if callback!=None:
+					callback()
+			except Exception as err:
+				with self.lock:
+					self.errors+=1
+					self.last_error=err
+			with self.lock:
+				line.pending-=1
+				if line.pending==0:
+					return
+
+	def event_counts(self):
+		"""
+		Return the number of edges seen on every registered line
+		"""
+		with self.lock:
+			return dict((kernel_id,line.count) for kernel_id,line in self.lines.items())
+
+	def debounce_stats(self):
+		"""
+		Return the (bounces,glitches) filtered on every registered line
+		"""
+		with self.lock:
+			return dict((kernel_id,(line.bounces,line.glitches)) for kernel_id,line in self.lines.items())
+
+	def error_stats(self):
+		"""
+		Return the number of errors caught by the reactor thread
+		and the callbacks, and the last one
+		"""
+		with self.lock:
+			return (self.errors,self.last_error)
+
+	def shutdown(self):
+		"""
+		Stop the reactor thread, wait for the running callbacks and
+		close all the file descriptors
+		"""
+		self.running=False
+		os.write(self.wake_w,b"x")
+		if threading.current_thread()!=self.thread:
+			self.thread.join()
+
+		with self.lock:
+			self.close()
+		self.pool.shutdown(wait=True)
+		os.close(self.wake_r)
+		os.close(self.wake_w)
+
+def get_edge_reactor():
+	global edge_reactor
+
+	with edge_reactor_lock:
+		if edge_reactor==None:
+			edge_reactor=EdgeReactor(edge_workers)
+		return edge_reactor
+
+def stop_edge_reactor():
+	global edge_reactor
+
+	with edge_reactor_lock:
+		if edge_reactor!=None:
+			edge_reactor.shutdown()
+			edge_reactor=None
+
+def watch_edge(kernel_id,value,callback=None,debouncingtime=0,queue=None,glitchtime=0):
+	"""
+	Call callback() from the edge reactor on the edges of a line:
+	value can be "rising", "falling", "both" or "none" to stop.
+	With debouncingtime an edge is reported once the level has been
+	stable for that many milliseconds; excursions shorter than
+	glitchtime milliseconds are ignored. The reported edges, with
+	their level and timestamp, are also pushed in queue if it is
+	an EdgeQueue
+	"""
+	#The lines watched by an event loop stay on both edges
+	if value=="none":
+		if not async_watched(kernel_id):
+			set_edge(kernel_id,value)
+		get_edge_reactor().unregister(kernel_id)
+	elif debouncingtime>0 or glitchtime>0 or async_watched(kernel_id):
+		set_edge(kernel_id,"both")
+		get_edge_reactor().register(kernel_id,callback,queue,value,debouncingtime,glitchtime)
+	else:
+		set_edge(kernel_id,value)
+		get_edge_reactor().register(kernel_id,callback,queue,value)
+
+## ASYNCIO #############################################################
+
+#AsyncEdges of every event loop, dropped once the loop is closed
+async_edges_loops=weakref.WeakKeyDictionary()
+
+class AsyncEdges(EdgePoller):
+	"""
+	Edge waiters of an asyncio event loop. The epoll set is watched
+	with loop.add_reader(), so waiting tasks cost no extra threads.
+	Lines are watched on both edges and every waiter filters the
+	ones it asked for, so the kernel edge setting used by the
+	EdgeReactor is never narrowed. With the cdev backend a line can
+	be watched either here or by the EdgeReactor, not by both
+	"""
+
+	def __init__(self,loop):
+		EdgePoller.__init__(self)
+		#A weak reference, or the loop would never leave async_edges_loops
+		self.loop=weakref.ref(loop)
+		self.lock=threading.Lock()
+		self.waiters={}
+		self.queues={}
+		loop.add_reader(self.epoll.fileno(),self.ready)
+
+	def watch(self,kernel_id):
+		with self.lock:
+			if kernel_id not in self.lines:
+				set_edge(kernel_id,"both")
+				self.add(EdgeLine(kernel_id))
+
+	def unwatch(self,kernel_id):
+		"""
+		Stop watching a line, i.e. before it is unexported. Its
+		waiters get None and its edges() iterators end
+		"""
+		with self.lock:
+			if self.remove(kernel_id)==None:
+				return
+			waiters=self.waiters.pop(kernel_id,[])
+			queues=self.queues.pop(kernel_id,[])
+		#Nobody is left waiting on a closed loop
+		loop=self.loop()
+		if loop==None or loop.is_closed():
+			return
+		try:
+			loop.call_soon_threadsafe(self.wake,waiters,queues)
+		except RuntimeError:
+			pass
+
+	def closed(self):
+		loop=self.loop()
+		return loop==None or loop.is_closed()
+
+	def wake(self,waiters,queues):
+		for future,value in waiters:
+			if not future.done():
+				future.set_result(None)
+		for queue,value in queues:
+			queue.put_nowait(None)
+
+	def ready(self):
+		with self.lock:
+			events=self.read_events(self.epoll.poll(0))
+			for event in events:
+				waiters=self.waiters.get(event.kernel_id,[])
+				for future,value in list(waiters):
+					if edge_matches(value,event.level):
+						waiters.remove((future,value))
+						if not future.done():
+							future.set_result(event)
+				for queue,value in self.queues.get(event.kernel_id,[]):
+					if edge_matches(value,event.level):
+						queue.put_nowait(event)
+
+	def close(self):
+		loop=self.loop()
+		if loop!=None and not loop.is_closed():
+			loop.remove_reader(self.epoll.fileno())
+		with self.lock:
+			EdgePoller.close(self)
+
+def edge_matches(value,level):
+	"""
+	Return True if an edge to level is one of value: "rising",
+	"falling" or "both"
+	"""
+	if value=="rising":
+		return level==1
+	if value=="falling":
+		return level==0
+	return True
+
+def get_async_edges():
+	loop=asyncio.get_running_loop()
+	edges=async_edges_loops.get(loop)
+	if edges==None:
+		edges=AsyncEdges(loop)
+		async_edges_loops[loop]=edges
+	return edges
+
+def open_async_edges():
+	"""
+	Return the AsyncEdges of the event loops still open, closing the
+	ones of the loops closed since, i.e. at the end of asyncio.run()
+	"""
+	result=[]
+	for loop,edges in list(async_edges_loops.items()):
+		if edges.closed():
+			async_edges_loops.pop(loop,None)
+			edges.close()
+		else:
+			result.append(edges)
+	return result
+
+def async_unwatch(kernel_id):
+	"""
+	Stop watching a line in all the event loops
+	"""
+	for edges in open_async_edges():
+		edges.unwatch(kernel_id)
+
+def async_watched(kernel_id):
+	return any(kernel_id in edges.lines for edges in open_async_edges())
+
+async def async_wait_edge(kernel_id,value="both",timeout=None):
+	"""
+	Wait for the next edge of a line and return its EdgeEvent,
+	or None after timeout seconds
+	"""
+	edges=get_async_edges()
+	edges.watch(kernel_id)
+	future=asyncio.get_running_loop().create_future()
+	with edges.lock:
+		edges.waiters.setdefault(kernel_id,[]).append((future,value))
+	try:
+		return await asyncio.wait_for(future,timeout)
+	except asyncio.TimeoutError:
+		with edges.lock:
+			waiters=edges.waiters.get(kernel_id,[])
+			if (future,value) in waiters:
+				waiters.remove((future,value))
+		return None
+
+async def async_edges(kernel_id,value="both"):
+	"""
+	Asynchronous generator of the EdgeEvent of a line, ending when
+	the line is released:
+
+		async for event in async_edges(kernel_id):
+			...
+	"""
+	edges=get_async_edges()
+	edges.watch(kernel_id)
+	queue=asyncio.Queue()
+	with edges.lock:
+		edges.queues.setdefault(kernel_id,[]).append((queue,value))
+	try:
+		while True:
+			event=await queue.get()
+			if event==None:
+				return
+			yield event
+	finally:
+		with edges.lock:
+			queues=edges.queues.get(kernel_id,[])
+			if (queue,value) in queues:
+				queues.remove((queue,value))
+
+async def async_get_value(kernel_id):
+	return get_value(kernel_id)
 
-def write8(bus,address,reg,value):
-	bus.write_byte_data(address,reg,value)
+## PIN #################################################################
 
 class Pin():
 	"""
 	FOX and AriaG25 pins related class
 	"""
 	kernel_id=None
+	owner=False
 	fd=None
 
 
 	def __init__(self,pin,mode):
 		self.kernel_id=pinname2kernelid(pin)
-		export(self.kernel_id)
-		direction(self.kernel_id,pinmode[mode])
+		request_line(self.kernel_id,pinmode[mode])
+		self.owner=True
 
 		iopath=get_gpio_path(self.kernel_id)
 		if os.path.exists(iopath): 
 			self.fd = open(iopath + '/value','r')
 
+	def close(self):
+		"""
+		Release the line, unexported when its last owner closes it
+		"""
+		if self.fd!=None:
+			self.fd.close()
+			self.fd=None
+		if self.owner:
+			release_line(self.kernel_id)
+			self.owner=False
+
 	def high(self):
 		set_value(self.kernel_id,1)
 		
@@ -1010,27 +3398,172 @@ class Pin():
 
 	get = get_value
 
-	def wait_edge(self,fd,callback,debouncingtime):
-		debouncingtime=debouncingtime/1000.0 # converto in millisecondi
-		timestampprec=time.time()
-		counter=0
-		po = select.epoll()
-		po.register(fd,select.EPOLLET)
-		while True:
-			events = po.poll()
-			timestamp=time.time()
-			if (timestamp-timestampprec>debouncingtime) and counter>0:
-				callback()
-			counter=counter+1
-			timestampprec=timestamp
-
-	def set_edge(self,value,callback,debouncingtime=0):
-		if self.fd!=None:
-			set_edge(self.kernel_id,value)
-			thread.start_new_thread(self.wait_edge,(self.fd,callback,debouncingtime))
-			return
-		else:		
-			thread.exit()
+	def set_edge(self,value,callback=None,debouncingtime=0,queue=None,glitchtime=0):
+		watch_edge(self.kernel_id,value,callback,debouncingtime,queue,glitchtime)
+
+	def wait_edge(self,value="both",timeout=None):
+		"""
+		Coroutine returning the EdgeEvent of the next edge
+		"""
+		return async_wait_edge(self.kernel_id,value,timeout)
+
+	def edges(self,value="both"):
+		"""
+		Asynchronous iterator of the EdgeEvent of the line
+		"""
+		return async_edges(self.kernel_id,value)
+
+	async def get_async(self):
+		return self.get_value()
+
+## PIN GROUP ###########################################################
+
+class PinGroup():
+	"""
+	Set of GPIO lines handled together as a bitmask, bit n being the
+	line pins[n]. Pins can be connector names (J4.7, D11.2), MCU names
+	(PA23), Kernel IDs or Pin/Daisy objects.
+
+	Writes skip the lines whose cached state is unchanged and use one
+	ioctl per gpiochip with the cdev backend, one write per changed line
+	with sysfs. The cached state is read back from the lines when the
+	group is created and then assumes the group is the only writer.
+
+	With mode="INPUT" snapshot() samples the whole bank, i.e. the
+	8 buttons of a DAISY-5 on D11:
+
+		buttons=PinGroup(["D11.%d" % i for i in range(2,10)],"INPUT")
+		(mask,timestamp)=buttons.snapshot()
+	"""
+
+	def __init__(self,pins,mode="OUTPUT"):
+		self.kernel_ids=[]
+		for pin in pins:
+			if isinstance(pin,str):
+				self.kernel_ids.append(pinname2kernelid(pin))
+			elif isinstance(pin,int):
+				self.kernel_ids.append(pin)
+			else:
+				self.kernel_ids.append(pin.kernel_id)
+
+		self.width=len(self.kernel_ids)
+		self.all=(1<<self.width)-1
+		self.lock=threading.Lock()
+		self.fds=[]
+		self.requests=[]
+		self.timestamp=None
+
+		self.state=0
+
+		request_lines(self.kernel_ids,pinmode[mode])
+
+		if gpio_backend=="cdev":
+			#Group bits by request to issue one ioctl for each of them
+			bits={}
+			for group_bit,kernel_id in enumerate(self.kernel_ids):
+				(req,bit)=gpio_lines[kernel_id]
+				bits.setdefault(req,[]).append((group_bit,bit))
+			for req,req_bits in bits.items():
+				req_mask=0
+				for group_bit,bit in req_bits:
+					req_mask|=1<<bit
+				self.requests.append((req,req_bits,req_mask))
+		else:
+			for kernel_id in self.kernel_ids:
+				self.fds.append(os.open(get_gpio_path(kernel_id) + '/value',os.O_RDWR))
+
+		#Lines already in use keep their level, start from the real one
+		self.snapshot()
+		self.timestamp=None
+
+	def write(self,mask):
+		"""
+		Set all the lines of the group from the bits of mask
+		"""
+		with self.lock:
+			mask&=self.all
+			changed=mask^self.state
+			if changed==0:
+				return
+
+			if self.fds:
+				while changed:
+					low=changed&-changed
+					bit=low.bit_length()-1
+					if mask&low:
+						os.pwrite(self.fds[bit],b"1",0)
+					else:
+						os.pwrite(self.fds[bit],b"0",0)
+					changed^=low
+			else:
+				for req,bits,lines_mask in self.requests:
+					req_mask=0
+					req_bits=0
+					for group_bit,bit in bits:
+						if changed&(1<<group_bit):
+							req_mask|=1<<bit
+							if mask&(1<<group_bit):
+								req_bits|=1<<bit
+					if req_mask:
+						req.set_values(req_bits,req_mask)
+
+			self.state=mask
+
+	def set_bits(self,mask):
+		"""
+		Turn on the lines in mask, leaving the others unchanged
+		"""
+		self.write(self.state|mask)
+
+	def clear_bits(self,mask):
+		"""
+		Turn off the lines in mask, leaving the others unchanged
+		"""
+		self.write(self.state&~mask)
+
+	def snapshot(self):
+		"""
+		Read the level of all the lines of the group. Return the
+		(mask,timestamp) pair, timestamp being time.monotonic()
+		"""
+		with self.lock:
+			mask=0
+			if self.fds:
+				pread=os.pread
+				for bit,fd in enumerate(self.fds):
+					if pread(fd,1,0)==b"1":
+						mask|=1<<bit
+			else:
+				for req,bits,req_mask in self.requests:
+					values=req.get_values(req_mask)
+					for group_bit,bit in bits:
+						if values&(1<<bit):
+							mask|=1<<group_bit
+
+			self.timestamp=time.monotonic()
+			self.state=mask
+			return (mask,self.timestamp)
+
+	def get(self):
+		return self.state
+
+	def __int__(self):
+		return self.state
+
+	def __bytes__(self):
+		return self.state.to_bytes((self.width+7)//8,'little')
+
+	def __len__(self):
+		return self.width
+
+	def close(self):
+		for fd in self.fds:
+			os.close(fd)
+		self.fds=[]
+		self.requests=[]
+		for kernel_id in self.kernel_ids:
+			release_line(kernel_id)
+		self.kernel_ids=[]
 
 ## DAISY-4 #############################################################
 
@@ -1041,6 +3574,7 @@ class Daisy4():
 	http://www.acmesystems.it/DAISY-4
 	"""
 	kernel_id=-1
+	owner=False
 
 	dips = {
 		'DIP1' :  '2',
@@ -1058,8 +3592,16 @@ class Daisy4():
 		self.kernel_id = pinname2kernelid(connector_id + "." + pin)
 
 		if (self.kernel_id!=0):
-			export(self.kernel_id)
-			direction(self.kernel_id,'low')
+			request_line(self.kernel_id,'low')
+			self.owner=True
+
+	def close(self):
+		"""
+		Release the line, unexported when its last owner closes it
+		"""
+		if self.owner:
+			release_line(self.kernel_id)
+			self.owner=False
 
 	def on(self):
 		if (self.kernel_id!=0):
@@ -1084,6 +3626,7 @@ class Daisy5():
 	http://www.acmesystems.it/DAISY-5
 	"""
 	kernel_id=None
+	owner=False
 	fd=None
 	
 	buttons = {
@@ -1102,13 +3645,24 @@ class Daisy5():
 		self.kernel_id = pinname2kernelid(connector_id + "." + pin)
 
 		if (self.kernel_id!=None):
-			export(self.kernel_id)
-			direction(self.kernel_id,'in')
+			request_line(self.kernel_id,'in')
+			self.owner=True
 
 			iopath=get_gpio_path(self.kernel_id)
 			if os.path.exists(iopath): 
 				self.fd = open(iopath + '/value','r')
 
+	def close(self):
+		"""
+		Release the line, unexported when its last owner closes it
+		"""
+		if self.fd!=None:
+			self.fd.close()
+			self.fd=None
+		if self.owner:
+			release_line(self.kernel_id)
+			self.owner=False
+
 	def pressed(self):
 		return self.get()
 
@@ -1120,28 +3674,104 @@ class Daisy5():
 				return False
 			else:
 				return True
-		return False
+		return get_value(self.kernel_id)==1
 
-	def wait_edge(self,fd,callback):
-		counter=0	
-		po = select.epoll()
-		po.register(fd,select.EPOLLET)
-		while True:
-			events = po.poll()
-			if counter>0:	
-				callback()
-			counter=counter+1
+	def set_edge(self,value,callback=None,debouncingtime=0,queue=None,glitchtime=0):
+		watch_edge(self.kernel_id,value,callback,debouncingtime,queue,glitchtime)
 
-	def set_edge(self,value,callback):
-		if self.fd!=None:
-			set_edge(self.kernel_id,value)
-			thread.start_new_thread(self.wait_edge,(self.fd,callback))
-			return
-		else:		
-			thread.exit()
+	def wait_edge(self,value="both",timeout=None):
+		"""
+		Coroutine returning the EdgeEvent of the next edge
+		"""
+		return async_wait_edge(self.kernel_id,value,timeout)
+
+	def edges(self,value="both"):
+		"""
+		Asynchronous iterator of the EdgeEvent of the line
+		"""
+		return async_edges(self.kernel_id,value)
+
+	async def get_async(self):
+		return self.get()
 
 ## DAISY-7 #############################################################
 
+class AxisStream():
+	"""
+	Ring buffer of X, Y, Z samples preallocated as an int16 array,
+	with their time.monotonic_ns() timestamps. Every sample is stored
+	twice, size samples apart, so the latest n samples are always
+	contiguous and latest() returns them without copies. The views
+	are live: a window of n samples stays valid for size-n new
+	samples only, copy it if it must last longer. With NumPy:
+
+		(samples,timestamps)=stream.latest(100)
+		xyz=numpy.frombuffer(samples,dtype=numpy.int16).reshape(-1,3)
+	"""
+
+	def __init__(self,size,rate):
+		self.size=size
+		self.rate=rate
+		self.samples=array.array('h',[0])*(6*size)
+		self.timestamps=array.array('Q',[0])*(2*size)
+		self.head=0
+		self.count=0
+		self.overruns=0
+
+	def push(self,x,y,z,timestamp):
+		samples=self.samples
+		for i in (self.head,self.head+self.size):
+			samples[3*i]=x
+			samples[3*i+1]=y
+			samples[3*i+2]=z
+			self.timestamps[i]=timestamp
+		self.head+=1
+		if self.head==self.size:
+			self.head=0
+		self.count+=1
+
+	def extend(self,values,timestamp):
+		"""
+		Append the samples of values (int16 array of X, Y, Z triplets)
+		with slice copies. The last one was taken at timestamp, the
+		previous ones are timestamped back one sample period apart
+		"""
+		n=len(values)//3
+		step=1000000000//self.rate
+		first=timestamp-(n-1)*step
+		self.count+=n
+		if n>self.size:
+			values=values[3*(n-self.size):]
+			first+=(n-self.size)*step
+			n=self.size
+
+		samples=self.samples
+		timestamps=self.timestamps
+		done=0
+		while done<n:
+			i=self.head
+			k=min(n-done,self.size-i)
+			chunk=values[3*done:3*(done+k)]
+			times=array.array('Q',range(first+done*step,first+(done+k)*step,step))
+			for j in (i,i+self.size):
+				samples[3*j:3*(j+k)]=chunk
+				timestamps[j:j+k]=times
+			done+=k
+			self.head=(i+k)%self.size
+
+	def latest(self,n):
+		"""
+		Return memoryviews of the latest n (at most size) samples,
+		oldest first: n*3 int16 axis values and n timestamps
+		"""
+		n=min(n,self.size,self.count)
+		end=self.head+self.size
+		return (memoryview(self.samples)[3*(end-n):3*end],
+			memoryview(self.timestamps)[end-n:end])
+
+	def __len__(self):
+		return min(self.count,self.size)
+
 class Daisy7():
 
 	"""
@@ -1256,19 +3886,6 @@ class Daisy7():
 		'PRESSUREDATA'		:	0xF6,
 		'READTEMPCMD'		:	0x2E,
 		'READPRESSURECMD'	:	0x34,
-
-		#Buffer for calibration data
-		'BUF_AC1' 			:	0,
-		'BUF_AC2' 			:	0,
-		'BUF_AC3' 			:	0,
-		'BUF_AC4' 			:	0,
-		'BUF_AC5' 			:	0,
-		'BUF_AC6' 			:	0,
-		'BUF_B1' 			:	0,
-		'BUF_B2' 			:	0,
-		'BUF_MB' 			:	0,
-		'BUF_MC' 			:	0,
-		'BUF_MD' 			:	0,
 		
 		#Operating mode
 		'ULTRALOWPOWER' 	:	0,
@@ -1286,8 +3903,51 @@ class Daisy7():
 	compass_address=0x1E
 	ser=-1
 	mode = baro_registers["STANDARD"]
+	acc_drdy=None
+	gyro_drdy=None
+	drdy_timeout=0.5
+
+	# Output data rates (Hz) -> CTRL_REG1 DR bits
+	acc_rates = {50:0x00, 100:0x08, 400:0x10, 1000:0x18}
+	gyro_rates = {100:0x00, 200:0x40, 400:0x80, 800:0xC0}
+
+	acc_stream=None
+	gyro_stream=None
+	stream_thread=None
+	streaming=False
+	gyro_fifo=False
+	gyro_watermark=0
+
+	# BMP085 calibration EEPROM (22 bytes from CAL_AC1)
+	baro_calibration_keys = ("AC1","AC2","AC3","AC4","AC5","AC6","B1","B2","MB","MC","MD")
+	baro_calibration_format = '>hhhHHHhhhhh'
+	baro_cal=None
+
+	# BMP085 conversion state
+	baro_temperature_time=0.005
+	baro_pressure_times={0:0.005, 1:0.008, 2:0.014, 3:0.026}
+	baro_state=None
+	baro_next=None
+	baro_deadline=0
+	baro_UT=None
+	baro_UP=None
+
+	# Temperature compensation (B5) cache, off with maxage 0
+	baro_B5=None
+	baro_B5_time=0
+	baro_B5_maxage=0
+	baro_B5_delta=None
+	baro_B5_moving=False
+	baro_B5_hits=0
+	baro_B5_misses=0
 	
-	def __init__(self,connector_id):
+	def __init__(self,connector_id,acc_drdy=None,gyro_drdy=None):
+		"""
+		acc_drdy and gyro_drdy are the GPIO lines (pin names or Kernel
+		IDs) wired to the accelerometer INT1 and the gyroscope DRDY
+		pins. With them the axis reads wait for the data ready edge
+		instead of polling STATUS_REG
+		"""
 		self.ser = serial.Serial(
 			port=serial_ports[connector_id], 
 			baudrate=115200, 
@@ -1298,7 +3958,7 @@ class Daisy7():
 		)  
 		self.ser.flushInput()
 
-		self.i2c_bus = smbus.SMBus(0)
+		self.i2c_bus = get_i2c_bus(0)
 		
 		if self.checkChipAdresses()==False:
 			raise IOError("I2C chip not found")
@@ -1312,6 +3972,16 @@ class Daisy7():
 		self.i2c_bus.write_byte_data(self.gyro_address,self.gyro_registers['CTRL_REG1'],0x0F)
 		#Full 2000dps to control REG4
 		self.i2c_bus.write_byte_data(self.gyro_address,self.gyro_registers['CTRL_REG4'],0x20)
+
+		#Data ready interrupts
+		if acc_drdy!=None:
+			#INT1 pin driven by the data ready signal (I1_CFG=10)
+			self.i2c_bus.write_byte_data(self.acc_address,self.acc_registers['CTRL_REG3'],0x02)
+			(self.acc_drdy,self.acc_queue)=self.drdy_watch(acc_drdy)
+		if gyro_drdy!=None:
+			#Data ready on the DRDY/INT2 pin (I2_DRDY)
+			self.i2c_bus.write_byte_data(self.gyro_address,self.gyro_registers['CTRL_REG3'],0x08)
+			(self.gyro_drdy,self.gyro_queue)=self.drdy_watch(gyro_drdy)
 		
 		#Compass setup
 		self.compass_setScale(1.3)
@@ -1355,6 +4025,212 @@ class Daisy7():
 		
 		return ret_str
 
+	def drdy_watch(self,pin):
+		if isinstance(pin,str):
+			kernel_id=pinname2kernelid(pin)
+		else:
+			kernel_id=pin
+		request_line(kernel_id,'in')
+		queue=EdgeQueue(16)
+		watch_edge(kernel_id,"rising",queue=queue)
+		return (kernel_id,queue)
+
+	def drdy_wait(self,kernel_id,queue):
+		"""
+		Wait for the data ready line. DRDY stays high until the data
+		are read, so an edge is awaited only while it is low. Return
+		False on timeout
+		"""
+		queue.drain()
+		if get_value(kernel_id)==1:
+			return True
+		return len(queue.drain(1,self.drdy_timeout))>0
+
+	# Gyroscope FIFO functions
+
+	def gyro_enableFifo(self,watermark=24):
+		"""
+		Buffer the gyroscope samples in its 32 levels FIFO (stream
+		mode: the oldest samples are overwritten when full)
+		"""
+		with self.i2c_bus:
+			ctrl_reg5=self.i2c_bus.read_byte_data(self.gyro_address,self.gyro_registers['CTRL_REG5'])
+			self.i2c_bus.write_byte_data(self.gyro_address,self.gyro_registers['CTRL_REG5'],ctrl_reg5|0x40)
+		#FM=010 stream mode, WTM=watermark
+		self.i2c_bus.write_byte_data(self.gyro_address,self.gyro_registers['FIFO_CTRL_REG'],0x40|(watermark&0x1F))
+		self.gyro_fifo=True
+		self.gyro_watermark=watermark&0x1F
+
+	def gyro_disableFifo(self):
+		#FM=000 bypass mode
+		self.i2c_bus.write_byte_data(self.gyro_address,self.gyro_registers['FIFO_CTRL_REG'],0x00)
+		with self.i2c_bus:
+			ctrl_reg5=self.i2c_bus.read_byte_data(self.gyro_address,self.gyro_registers['CTRL_REG5'])
+			self.i2c_bus.write_byte_data(self.gyro_address,self.gyro_registers['CTRL_REG5'],ctrl_reg5&~0x40)
+		self.gyro_fifo=False
+
+	def gyro_getFifoLevel(self):
+		"""
+		Return the (samples in the FIFO,overrun) pair from FIFO_SRC_REG
+		"""
+		fifo_src=self.i2c_bus.read_byte_data(self.gyro_address,self.gyro_registers['FIFO_SRC_REG'])
+		overrun=(fifo_src&0x40)!=0
+		if overrun:
+			return (32,True)
+		return (fifo_src&0x1F,False)
+
+	def gyro_readFifo(self,level=None):
+		"""
+		Drain the FIFO in one auto-increment transfer and return the
+		samples as an int16 array of X, Y, Z triplets
+		"""
+		if level==None:
+			(level,overrun)=self.gyro_getFifoLevel()
+		values=array.array('h')
+		if level>0:
+			values.frombytes(self.i2c_bus.read_block(self.gyro_address,self.gyro_registers['OUT_X_L']|0x80,6*level))
+			if sys.byteorder=="big":
+				values.byteswap()
+		return values
+
+	# STREAMING functions
+
+	def start_stream(self,rate=100,buffer_seconds=10,gyro_fifo=False):
+		"""
+		Sample accelerometer and gyroscope continuously from a thread
+		in acc_stream and gyro_stream (AxisStream), buffer_seconds
+		of data each. Each chip runs at its lowest output data rate
+		not below rate. With gyro_fifo the gyroscope samples are
+		buffered in its FIFO and drained in bursts
+		"""
+		self.stop_stream()
+
+		acc_rate=min([r for r in self.acc_rates if r>=rate] or [max(self.acc_rates)])
+		gyro_rate=min([r for r in self.gyro_rates if r>=rate] or [max(self.gyro_rates)])
+
+		#Normal mode, all the axes on
+		self.i2c_bus.write_byte_data(self.acc_address,self.acc_registers['CTRL_REG1'],0x27&~0x18|self.acc_rates[acc_rate])
+		self.i2c_bus.write_byte_data(self.gyro_address,self.gyro_registers['CTRL_REG1'],0x0F|self.gyro_rates[gyro_rate])
+
+		self.acc_stream=AxisStream(int(acc_rate*buffer_seconds),acc_rate)
+		self.gyro_stream=AxisStream(int(gyro_rate*buffer_seconds),gyro_rate)
+		if gyro_fifo:
+			self.gyro_enableFifo()
+		self.streaming=True
+		self.stream_thread=threading.Thread(target=self.stream,name="ablib-daisy7",daemon=True)
+		self.stream_thread.start()
+
+	def stop_stream(self):
+		self.streaming=False
+		if self.stream_thread!=None:
+			self.stream_thread.join()
+			self.stream_thread=None
+			if self.gyro_fifo:
+				self.gyro_disableFifo()
+
+	def stream_ready(self,address,registers,drdy,stream):
+		"""
+		Return True if a new data set is ready, from the data ready
+		line if wired or else from STATUS_REG, counting the overruns
+		"""
+		if drdy!=None:
+			return get_value(drdy)==1
+		status=self.i2c_bus.read_byte_data(address,registers['STATUS_REG'])
+		if status&0x80:
+			stream.overruns+=1
+		return (status&0x08)!=0
+
+	def stream_fifo(self):
+		"""
+		Drain the gyroscope FIFO once it reaches the watermark
+		"""
+		(level,overrun)=self.gyro_getFifoLevel()
+		if overrun:
+			self.gyro_stream.overruns+=1
+		if level<self.gyro_watermark:
+			return False
+		values=self.gyro_readFifo(level)
+		self.gyro_stream.extend(values,time.monotonic_ns())
+		return True
+
+	def stream(self):
+		sensors=[(self.acc_address,self.acc_registers,self.acc_drdy,self.acc_stream)]
+		if self.gyro_fifo:
+			gyro_period=float(self.gyro_watermark)/self.gyro_stream.rate
+		else:
+			sensors.append((self.gyro_address,self.gyro_registers,self.gyro_drdy,self.gyro_stream))
+			gyro_period=1.0/self.gyro_stream.rate
+		#Poll twice per sample period (FIFO watermark for the gyroscope
+		#in FIFO mode) of the fastest chip
+		idle=0.5*min(1.0/self.acc_stream.rate,gyro_period)
+		while self.streaming:
+			ready=False
+			if self.gyro_fifo and self.stream_fifo():
+				ready=True
+			for (address,registers,drdy,stream) in sensors:
+				if self.stream_ready(address,registers,drdy,stream):
+					data=self.i2c_bus.read_i2c_block_data(address,registers['OUT_X_L']|0x80,6)
+					(x,y,z)=struct.unpack('<hhh',bytes(data))
+					stream.push(x,y,z,time.monotonic_ns())
+					ready=True
+			if not ready:
+				time.sleep(idle)
+
+	def acc_latest(self,n):
+		"""
+		Return the latest n accelerometer samples, see AxisStream.latest()
+		"""
+		return self.acc_stream.latest(n)
+
+	def gyro_latest(self,n):
+		"""
+		Return the latest n gyroscope samples, see AxisStream.latest()
+		"""
+		return self.gyro_stream.latest(n)
+
+	def stream_stats(self):
+		"""
+		Return the samples taken and the overruns seen by each chip
+		"""
+		return {
+			"acc_samples"   : self.acc_stream.count,
+			"acc_overruns"  : self.acc_stream.overruns,
+			"gyro_samples"  : self.gyro_stream.count,
+			"gyro_overruns" : self.gyro_stream.overruns
+		}
+
+	def close(self):
+		self.stop_stream()
+		for kernel_id in (self.acc_drdy,self.gyro_drdy):
+			if kernel_id!=None:
+				watch_edge(kernel_id,"none")
+				release_line(kernel_id)
+		self.acc_drdy=None
+		self.gyro_drdy=None
+		self.ser.close()
+		if self.i2c_bus!=-1:
+			release_i2c_bus(0)
+			self.i2c_bus=-1
+
+	def readAll(self):
+		"""
+		Read all the MEMS sensors, the accelerometer, gyroscope and
+		compass ones while the barometer converts
+		"""
+		self.baro_startMeasure()
+		acc=self.acc_getAxes()
+		gyro=self.gyro_getAxes()
+		compass=self.compass_getAxes()
+		self.baro_wait()
+		(temperature,pressure)=self.baro_result()
+		return {
+			"acc"         : acc,
+			"gyro"        : gyro,
+			"compass"     : compass,
+			"temperature" : temperature,
+			"pressure"    : pressure
+		}
+
 	def readNMEAmsg(self):
 		self.ser.flushInput()
 		return self.ser.readline().replace("\r\n","")
@@ -1412,183 +4288,233 @@ class Daisy7():
 	# ACCELLEROMETER functions
 
 	def acc_getAxes(self):
-		while True:
-			self.i2c_bus.write_byte(self.acc_address,self.acc_registers['STATUS_REG'])		
-			status_reg=self.i2c_bus.read_byte(self.acc_address)		
-			if (status_reg&0x08)!=0:
-				break	
-
-		#Read X axis value
-		self.i2c_bus.write_byte(self.acc_address,self.acc_registers['OUT_X_L'])		
-		OUT_X_L=self.i2c_bus.read_byte(self.acc_address)		
-		self.i2c_bus.write_byte(self.acc_address,self.acc_registers['OUT_X_H'])		
-		OUT_X_H=self.i2c_bus.read_byte(self.acc_address)		
-
-		#Read Y axis value
-		self.i2c_bus.write_byte(self.acc_address,self.acc_registers['OUT_Y_L'])		
-		OUT_Y_L=self.i2c_bus.read_byte(self.acc_address)		
-		self.i2c_bus.write_byte(self.acc_address,self.acc_registers['OUT_Y_H'])		
-		OUT_Y_H=self.i2c_bus.read_byte(self.acc_address)		
-
-		#Read Z axis value
-		self.i2c_bus.write_byte(self.acc_address,self.acc_registers['OUT_Z_L'])		
-		OUT_Z_L=self.i2c_bus.read_byte(self.acc_address)		
-		self.i2c_bus.write_byte(self.acc_address,self.acc_registers['OUT_Z_H'])		
-		OUT_Z_H=self.i2c_bus.read_byte(self.acc_address)		
-
-		xValue=self.getSignedNumber(OUT_X_H<<8|OUT_X_L)
-		yValue=self.getSignedNumber(OUT_Y_H<<8|OUT_Y_L)
-		zValue=self.getSignedNumber(OUT_Z_H<<8|OUT_Z_L)
-
-		return (xValue,yValue,zValue)
+		#Wait for a new X, Y, Z data set, polling ZYXDA in STATUS_REG
+		#without the data ready line or if its edge gets lost
+		if self.acc_drdy==None or not self.drdy_wait(self.acc_drdy,self.acc_queue):
+			while (self.i2c_bus.read_byte_data(self.acc_address,self.acc_registers['STATUS_REG'])&0x08)==0:
+				pass
+
+		#Read OUT_X_L..OUT_Z_H in one transfer. The MSB of the register
+		#address enables the address auto-increment
+		data=self.i2c_bus.read_i2c_block_data(self.acc_address,self.acc_registers['OUT_X_L']|0x80,6)
+		return struct.unpack('<hhh',bytes(data))
 
 	# GYRO functions
 
 	def gyro_getAxes(self):
-		while True:
-			self.i2c_bus.write_byte(self.gyro_address,self.gyro_registers['STATUS_REG'])		
-			status_reg=self.i2c_bus.read_byte(self.gyro_address)		
-			if (status_reg&0x08)!=0:
-				break
-
-		#Read X axis value
-		self.i2c_bus.write_byte(self.gyro_address,self.gyro_registers['OUT_X_L'])		
-		OUT_X_L=self.i2c_bus.read_byte(self.gyro_address)		
-		self.i2c_bus.write_byte(self.gyro_address,self.gyro_registers['OUT_X_H'])		
-		OUT_X_H=self.i2c_bus.read_byte(self.gyro_address)		
-		xValue=self.getSignedNumber(OUT_X_H<<8 | OUT_X_L)
-
-		#Read Y axis value
-		self.i2c_bus.write_byte(self.gyro_address,self.gyro_registers['OUT_Y_L'])		
-		OUT_Y_L=self.i2c_bus.read_byte(self.gyro_address)		
-		self.i2c_bus.write_byte(self.gyro_address,self.gyro_registers['OUT_Y_H'])		
-		OUT_Y_H=self.i2c_bus.read_byte(self.gyro_address)		
-		yValue=self.getSignedNumber(OUT_Y_H<<8 | OUT_Y_L)
-
-		#Read Z axis value
-		self.i2c_bus.write_byte(self.gyro_address,self.gyro_registers['OUT_Z_L'])		
-		OUT_Z_L=self.i2c_bus.read_byte(self.gyro_address)		
-		self.i2c_bus.write_byte(self.gyro_address,self.gyro_registers['OUT_Z_H'])		
-		OUT_Z_H=self.i2c_bus.read_byte(self.gyro_address)		
-		zValue=self.getSignedNumber(OUT_Z_H<<8 | OUT_Z_L)
-
-		xValue=self.getSignedNumber(OUT_X_H<<8|OUT_X_L)
-		yValue=self.getSignedNumber(OUT_Y_H<<8|OUT_Y_L)
-		zValue=self.getSignedNumber(OUT_Z_H<<8|OUT_Z_L)
-
-		return (xValue,yValue,zValue)
+		#Wait for a new X, Y, Z data set, polling ZYXDA in STATUS_REG
+		#without the data ready line or if its edge gets lost
+		if self.gyro_drdy==None or not self.drdy_wait(self.gyro_drdy,self.gyro_queue):
+			while (self.i2c_bus.read_byte_data(self.gyro_address,self.gyro_registers['STATUS_REG'])&0x08)==0:
+				pass
+
+		#Read OUT_X_L..OUT_Z_H in one transfer. The MSB of the register
+		#address enables the address auto-increment
+		data=self.i2c_bus.read_i2c_block_data(self.gyro_address,self.gyro_registers['OUT_X_L']|0x80,6)
+		return struct.unpack('<hhh',bytes(data))
 
 	# BAROMETER functions
 	# Some parts of this code become from the Adafruit I2C libraries
 	# https://github.com/adafruit/Adafruit-Raspberry-Pi-Python-Code/blob/master/Adafruit_BMP085/Adafruit_BMP085.py
 
+	def baro_startTemperature(self):
+		"""
+		Start a temperature conversion, see baro_poll()
+		"""
+		self.i2c_bus.write_byte_data(self.baro_registers['I2C_ADDR'],self.baro_registers['CONTROL'],self.baro_registers['READTEMPCMD'])
+		self.baro_state="temperature"
+		self.baro_deadline=time.monotonic()+self.baro_temperature_time
+
+	def baro_startPressure(self):
+		"""
+		Start a pressure conversion in the current mode, see baro_poll()
+		"""
+		write8(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers["CONTROL"], self.baro_registers["READPRESSURECMD"] + (self.mode << 6))
+		self.baro_state="pressure"
+		self.baro_deadline=time.monotonic()+self.baro_pressure_times[self.mode]
+
+	def baro_startMeasure(self):
+		"""
+		Start a temperature conversion followed by a pressure one,
+		just the pressure one if the cached B5 is still valid
+		"""
+		if self.baro_cachedB5():
+			self.baro_startPressure()
+		else:
+			self.baro_startTemperature()
+			self.baro_next=self.baro_startPressure
+
+	def baro_setTemperatureCache(self,maxage=0,delta=None):
+		"""
+		Reuse the temperature compensation of a pressure read for
+		maxage milliseconds (0 to measure the temperature every time).
+		With delta the cache is skipped while the temperature moves
+		by more than delta Celsius degrees between two measures
+		"""
+		self.baro_B5_maxage=maxage/1000.0
+		self.baro_B5_delta=delta
+		self.baro_B5_moving=False
+
+	def baro_cachedB5(self):
+		"""
+		Return True if the cached B5 can be used, counting hits
+		and misses
+		"""
+		if self.baro_B5_maxage<=0:
+			return False
+		if self.baro_B5!=None and not self.baro_B5_moving and time.monotonic()-self.baro_B5_time<self.baro_B5_maxage:
+			self.baro_B5_hits+=1
+			return True
+		self.baro_B5_misses+=1
+		return False
+
+	def baro_setB5(self,UT):
+		B5=self.baro_computeB5(UT)
+		if self.baro_B5_delta!=None and self.baro_B5!=None:
+			#B5 is 16 times the temperature in 0.1 degrees
+			self.baro_B5_moving=abs(B5-self.baro_B5)>self.baro_B5_delta*160
+		self.baro_B5=B5
+		self.baro_B5_time=time.monotonic()
+
+	def baro_getCacheStats(self):
+		"""
+		Return the hits and misses of the temperature compensation cache
+		"""
+		return {
+			"hits"   : self.baro_B5_hits,
+			"misses" : self.baro_B5_misses
+		}
+
+	def baro_poll(self):
+		"""
+		Advance the conversions without blocking: read the result of
+		the current one if it is over and start the next one. Return
+		the seconds to wait before polling again, None when done
+		"""
+		if self.baro_state==None:
+			return None
+		delay=self.baro_deadline-time.monotonic()
+		if delay>0:
+			return delay
+
+		address=self.baro_registers['I2C_ADDR']
+		if self.baro_state=="temperature":
+			self.baro_UT=readU16(self.i2c_bus,address,self.baro_registers['TEMPDATA'])
+			self.baro_setB5(self.baro_UT)
+		else:
+			(msb,lsb,xlsb)=self.i2c_bus.read_i2c_block_data(address,self.baro_registers["PRESSUREDATA"],3)
+			self.baro_UP=((msb << 16) + (lsb << 8) + xlsb) >> (8 - self.mode)
+		self.baro_state=None
+
+		if self.baro_next!=None:
+			start=self.baro_next
+			self.baro_next=None
+			start()
+			return self.baro_poll()
+		return None
+
+	def baro_wait(self):
+		"""
+		Sleep until the pending conversions are over
+		"""
+		delay=self.baro_poll()
+		while delay!=None:
+			time.sleep(delay)
+			delay=self.baro_poll()
+
+	def baro_result(self):
+		"""
+		Return (temperature in C,pressure in Pa) from the latest
+		conversions, None for what has not been measured
+		"""
+		if self.baro_B5==None:
+			return (None,None)
+		temperature=((self.baro_B5 + 8) >> 4) / 10.0
+		if self.baro_UP==None:
+			return (temperature,None)
+		return (temperature,self.baro_compensatePressure(self.baro_B5,self.baro_UP))
+
 	def baro_getRawTemperature(self):
-		self.i2c_bus.write_byte_data(self.baro_registers['I2C_ADDR'],self.baro_registers['CONTROL'],self.baro_registers['READTEMPCMD'])	
-		time.sleep(0.005)
-		temperature=readU16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['TEMPDATA'])		
-		return temperature
+		self.baro_startTemperature()
+		self.baro_wait()
+		return self.baro_UT
 
-	def baro_getTemperature(self):
-		UT = 0
-		X1 = 0
-		X2 = 0
-		B5 = 0
-		temp = 0.0
+	def baro_computeB5(self,UT):
+		X1 = ((UT - self.baro_cal["AC6"]) * self.baro_cal["AC5"]) >> 15
+		X2 = int((self.baro_cal["MC"] << 11) / (X1 + self.baro_cal["MD"]))
+		return X1 + X2
 
+	def baro_computeTemperature(self,UT):
+		B5 = self.baro_computeB5(UT)
+		return ((B5 + 8) >> 4) / 10.0
+
+	def baro_getTemperature(self):
 		# Read raw temp before aligning it with the calibration values
-		UT = self.baro_getRawTemperature()
-		X1 = ((UT - self.baro_registers["BUF_AC6"]) * self.baro_registers["BUF_AC5"]) >> 15
-		X2 = (self.baro_registers["BUF_MC"] << 11) / (X1 + self.baro_registers["BUF_MD"])
-		B5 = X1 + X2
-		temp = ((B5 + 8) >> 4) / 10.0
-		return temp
+		return self.baro_computeTemperature(self.baro_getRawTemperature())
 		
 	def baro_getCalibrationData(self):
-		self.baro_registers["BUF_AC1"]=readS16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_AC1'])	
-		self.baro_registers["BUF_AC2"]=readS16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_AC2'])	
-		self.baro_registers["BUF_AC3"]=readS16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_AC3'])	
-		self.baro_registers["BUF_AC4"]=readU16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_AC4'])	
-		self.baro_registers["BUF_AC5"]=readU16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_AC5'])	
-		self.baro_registers["BUF_AC6"]=readU16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_AC6'])	
-		self.baro_registers["BUF_B1"]=readS16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_B1'])	
-		self.baro_registers["BUF_B2"]=readS16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_B2'])	
-		self.baro_registers["BUF_MB"]=readS16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_MB'])	
-		self.baro_registers["BUF_MC"]=readS16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_MC'])	
-		self.baro_registers["BUF_MD"]=readS16(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_MD'])	
-		
+		"""
+		Read the calibration EEPROM in one block transfer
+		"""
+		data=bytes(self.i2c_bus.read_i2c_block_data(self.baro_registers['I2C_ADDR'],self.baro_registers['CAL_AC1'],22))
+		if not self.baro_setCalibration(data):
+			raise IOError("Wrong BMP085 calibration data")
+
+	def baro_setCalibration(self,data):
+		"""
+		Decode the 22 bytes of the calibration EEPROM in baro_cal.
+		Return False if a word is 0x0000 or 0xFFFF (a bad read)
+		"""
+		if len(data)!=22:
+			return False
+		for i in range(0,22,2):
+			if data[i:i+2] in (b"\x00\x00",b"\xff\xff"):
+				return False
+		values=struct.unpack(self.baro_calibration_format,data)
+		self.baro_cal=dict(zip(self.baro_calibration_keys,values))
+		return True
+
 	def baro_showCalibrationData(self):
-		print ( "CAL_AC1 = %6d" % (self.baro_registers["BUF_AC1"]))
-		print ( "CAL_AC2 = %6d" % (self.baro_registers["BUF_AC2"]))
-		print ( "CAL_AC3 = %6d" % (self.baro_registers["BUF_AC3"]))
-		print ( "CAL_AC4 = %6d" % (self.baro_registers["BUF_AC4"]))
-		print ( "CAL_AC5 = %6d" % (self.baro_registers["BUF_AC5"]))
-		print ( "CAL_AC6 = %6d" % (self.baro_registers["BUF_AC6"]))
-		print ( " CAL_B1 = %6d" % (self.baro_registers["BUF_B1"]))
-		print ( " CAL_B2 = %6d" % (self.baro_registers["BUF_B2"]))
-		print ( " CAL_MB = %6d" % (self.baro_registers["BUF_MB"]))
-		print ( " CAL_MC = %6d" % (self.baro_registers["BUF_MC"]))
-		print ( " CAL_MD = %6d" % (self.baro_registers["BUF_MD"]))
+		print ( "CAL_AC1 = %6d" % (self.baro_cal["AC1"]))
+		print ( "CAL_AC2 = %6d" % (self.baro_cal["AC2"]))
+		print ( "CAL_AC3 = %6d" % (self.baro_cal["AC3"]))
+		print ( "CAL_AC4 = %6d" % (self.baro_cal["AC4"]))
+		print ( "CAL_AC5 = %6d" % (self.baro_cal["AC5"]))
+		print ( "CAL_AC6 = %6d" % (self.baro_cal["AC6"]))
+		print ( " CAL_B1 = %6d" % (self.baro_cal["B1"]))
+		print ( " CAL_B2 = %6d" % (self.baro_cal["B2"]))
+		print ( " CAL_MB = %6d" % (self.baro_cal["MB"]))
+		print ( " CAL_MC = %6d" % (self.baro_cal["MC"]))
+		print ( " CAL_MD = %6d" % (self.baro_cal["MD"]))
 		  
 	def baro_getRawPressure(self):
-		write8(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers["CONTROL"], self.baro_registers["READPRESSURECMD"] + (self.mode << 6))
-
-		if (self.mode == self.baro_registers["ULTRALOWPOWER"]):
-			time.sleep(0.005)
-		elif (self.mode == self.baro_registers["HIGHRES"]):
-			time.sleep(0.014)
-		elif (self.mode == self.baro_registers["ULTRAHIGHRES"]):
-			time.sleep(0.026)
-		else:
-			time.sleep(0.008)
-
-		msb =  readU8(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers["PRESSUREDATA"])
-		lsb =  readU8(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers["PRESSUREDATA"]+1)
-		xlsb = readU8(self.i2c_bus,self.baro_registers['I2C_ADDR'],self.baro_registers["PRESSUREDATA"]+2)
-		
-		raw = ((msb << 16) + (lsb << 8) + xlsb) >> (8 - self.mode)
-		return raw		  
-
-	def baro_getPressure(self):
-		"Gets the compensated pressure in pascal"
-		UT = 0
-		UP = 0
-		B3 = 0
-		B5 = 0
-		B6 = 0
-		X1 = 0
-		X2 = 0
-		X3 = 0
-		p = 0
-		B4 = 0
-		B7 = 0
-
-		UT = self.baro_getRawTemperature()
-		UP = self.baro_getRawPressure()
+		self.baro_startPressure()
+		self.baro_wait()
+		return self.baro_UP
 
-		# True Temperature Calculations
-		X1 = ((UT - self.baro_registers["CAL_AC6"]) * self.baro_registers["CAL_AC5"]) >> 15
-		X2 = (self.baro_registers["CAL_MC"] << 11) / (X1 + self.baro_registers["CAL_MD"])
-		B5 = X1 + X2
+	def baro_computePressure(self,UT,UP):
+		"Compensates the raw pressure, in pascal"
+		return self.baro_compensatePressure(self.baro_computeB5(UT),UP)
 
+	def baro_compensatePressure(self,B5,UP):
 		# Pressure Calculations
 		B6 = B5 - 4000
-		X1 = (self.baro_registers["CAL_B2"] * (B6 * B6) >> 12) >> 11
-		X2 = (self.baro_registers["CAL_AC2"] * B6) >> 11
+		X1 = (self.baro_cal["B2"] * ((B6 * B6) >> 12)) >> 11
+		X2 = (self.baro_cal["AC2"] * B6) >> 11
 		X3 = X1 + X2
-		B3 = (((self.baro_registers["CAL_AC1"] * 4 + X3) << self.mode) + 2) / 4
+		B3 = int((((self.baro_cal["AC1"] * 4 + X3) << self.mode) + 2) / 4)
 
-		X1 = (self.baro_registers["CAL_AC3"] * B6) >> 13
-		X2 = (self.baro_registers["CAL_B1"] * ((B6 * B6) >> 12)) >> 16
+		X1 = (self.baro_cal["AC3"] * B6) >> 13
+		X2 = (self.baro_cal["B1"] * ((B6 * B6) >> 12)) >> 16
 		X3 = ((X1 + X2) + 2) >> 2
-		B4 = (self.baro_registers["CAL_AC4"] * (X3 + 32768)) >> 15
+		B4 = (self.baro_cal["AC4"] * (X3 + 32768)) >> 15
 		B7 = (UP - B3) * (50000 >> self.mode)
 
-
 		if (B7 < 0x80000000):
-			p = (B7 * 2) / B4
+			p = (B7 * 2) // B4
 		else:
-			p = (B7 / B4) * 2
-      
+			p = (B7 // B4) * 2
+
 		X1 = (p >> 8) * (p >> 8)
 		X1 = (X1 * 3038) >> 16
 		X2 = (-7357 * p) >> 16
@@ -1597,6 +4523,13 @@ class Daisy7():
 
 		return p
 
+	def baro_getPressure(self):
+		"Gets the compensated pressure in pascal"
+		if not self.baro_cachedB5():
+			self.baro_getRawTemperature()
+		UP = self.baro_getRawPressure()
+		return self.baro_compensatePressure(self.baro_B5,UP)
+
 	def baro_getAltitude(self, seaLevelPressure=101325):
 		"Calculates the altitude in meters"
 		altitude = 0.0
@@ -1698,43 +4631,14 @@ class Daisy7():
 		return str(degrees)+"\u00b0 "+str(minutes)+"'"
 		
 	def compass_getAxes(self):
-		#Read X axis value
-		self.i2c_bus.write_byte(self.compass_address,self.compass_registers['OUT_X_L'])		
-		OUT_X_L=self.i2c_bus.read_byte(self.compass_address)		
-		self.i2c_bus.write_byte(self.compass_address,self.compass_registers['OUT_X_H'])		
-		OUT_X_H=self.i2c_bus.read_byte(self.compass_address)		
-		xValue=self.getSignedNumber(OUT_X_H<<8 | OUT_X_L)
-
-		#Read Y axis value
-		self.i2c_bus.write_byte(self.compass_address,self.compass_registers['OUT_Y_L'])		
-		OUT_Y_L=self.i2c_bus.read_byte(self.compass_address)		
-		self.i2c_bus.write_byte(self.compass_address,self.compass_registers['OUT_Y_H'])		
-		OUT_Y_H=self.i2c_bus.read_byte(self.compass_address)		
-		yValue=self.getSignedNumber(OUT_Y_H<<8 | OUT_Y_L)
-
-		#Read Z axis value
-		self.i2c_bus.write_byte(self.compass_address,self.compass_registers['OUT_Z_L'])		
-		OUT_Z_L=self.i2c_bus.read_byte(self.compass_address)		
-		self.i2c_bus.write_byte(self.compass_address,self.compass_registers['OUT_Z_H'])		
-		OUT_Z_H=self.i2c_bus.read_byte(self.compass_address)		
-		zValue=self.getSignedNumber(OUT_Z_H<<8 | OUT_Z_L)
-		
-		if (xValue == -4096):
-			xValue = None
-		else:
-			xValue = round(xValue * self.scale, 4)
-			
-		if (yValue == -4096):
-			yValue = None
-		else:
-			yValue = round(yValue * self.scale, 4)
-			
-		if (zValue == -4096):
-			zValue = None
-		else:
-			zValue = round(zValue * self.scale, 4)
-			
-		return (xValue, yValue, zValue)
+		#The HMC5883L moves the register pointer by itself, so one
+		#transfer reads the big endian OUT_X, OUT_Z and OUT_Y registers
+		data=self.i2c_bus.read_i2c_block_data(self.compass_address,self.compass_registers['OUT_X_H'],6)
+		(xValue,zValue,yValue)=struct.unpack('>hhh',bytes(data))
+
+		#-4096 flags an ADC overflow on the axis
+		scale=self.scale
+		return tuple(None if value==-4096 else round(value*scale,4) for value in (xValue,yValue,zValue))
 
 ## DAISY-8 #############################################################
 
@@ -1745,6 +4649,7 @@ class Daisy8():
 	http://www.acmesystems.it/DAISY-8
 	"""
 	kernel_id=-1
+	owner=False
 	fd=None
 
 
@@ -1771,17 +4676,28 @@ class Daisy8():
 		self.kernel_id = pinname2kernelid(connector + "." + pin)
 
 		if (self.kernel_id!=0 and id[0:2]=="RL"):
-			export(self.kernel_id)
-			direction(self.kernel_id,'low')
+			request_line(self.kernel_id,'low')
+			self.owner=True
 
 		if (self.kernel_id!=0 and id[0:2]=="IN"):
-			export(self.kernel_id)
-			direction(self.kernel_id,'in')
+			request_line(self.kernel_id,'in')
+			self.owner=True
 
 			iopath=get_gpio_path(self.kernel_id)
 			if os.path.exists(iopath): 
 				self.fd = open(iopath + '/value','r')
 
+	def close(self):
+		"""
+		Release the line, unexported when its last owner closes it
+		"""
+		if self.fd!=None:
+			self.fd.close()
+			self.fd=None
+		if self.owner:
+			release_line(self.kernel_id)
+			self.owner=False
+
 	def on(self):
 		if (self.kernel_id!=0):
 			set_value(self.kernel_id,1)
@@ -1802,25 +4718,25 @@ class Daisy8():
 				return False
 			else:
 				return True
-		return False
+		return get_value(self.kernel_id)==1
 			
-	def wait_edge(self,fd,callback):
-		counter=0	
-		po = select.epoll()
-		po.register(fd,select.EPOLLET)
-		while True:
-			events = po.poll()
-			if counter>0:	
-				callback()
-			counter=counter+1
+	def set_edge(self,value,callback=None,debouncingtime=0,queue=None,glitchtime=0):
+		watch_edge(self.kernel_id,value,callback,debouncingtime,queue,glitchtime)
 
-	def set_edge(self,value,callback):
-		if self.fd!=None:
-			set_edge(self.kernel_id,value)
-			thread.start_new_thread(self.wait_edge,(self.fd,callback))
-			return
-		else:		
-			thread.exit()
+	def wait_edge(self,value="both",timeout=None):
+		"""
+		Coroutine returning the EdgeEvent of the next edge
+		"""
+		return async_wait_edge(self.kernel_id,value,timeout)
+
+	def edges(self,value="both"):
+		"""
+		Asynchronous iterator of the EdgeEvent of the line
+		"""
+		return async_edges(self.kernel_id,value)
+
+	async def get_async(self):
+		return self.get()
 			
 ## DAISY-10 ############################################################
 
@@ -1878,6 +4794,7 @@ class Daisy11():
 	"""
 
 	kernel_id=-1
+	owner=False
 
 	leds = {
 		'L1' :  '2',
@@ -1895,10 +4812,18 @@ class Daisy11():
 		self.kernel_id = pinname2kernelid(connector_id + "." + pin)
 
 		if (self.kernel_id!=0):
-			export(self.kernel_id)
-			direction(self.kernel_id,'low')
+			request_line(self.kernel_id,'low')
+			self.owner=True
 
 
+	def close(self):
+		"""
+		Release the line, unexported when its last owner closes it
+		"""
+		if self.owner:
+			release_line(self.kernel_id)
+			self.owner=False
+
 	def on(self):
 		if (self.kernel_id!=0):
 			set_value(self.kernel_id,1)
@@ -1934,8 +4859,9 @@ class Daisy14():
 	e = -1
 
 	def __init__(self,bus_id=0,i2c_address=0x20):
+		self.bus_id = bus_id
 		self.i2c_address = i2c_address
-		self.i2c_bus = smbus.SMBus(bus_id)
+		self.i2c_bus = get_i2c_bus(bus_id)
 		self.rs=Daisy22(bus_id,i2c_address,4)
 		self.e=Daisy22(bus_id,i2c_address,5)
 		self.rs.off()
@@ -1976,9 +4902,10 @@ class Daisy14():
 		self.e.off()
 		
 	def sendnibble(self,value):
-		currentvalue=self.i2c_bus.read_byte(self.i2c_address)
-		self.i2c_bus.write_byte(self.i2c_address,value&0x0F|currentvalue&0xF0)
-		self.e_strobe()
+		with self.i2c_bus:
+			currentvalue=self.i2c_bus.read_byte(self.i2c_address)
+			self.i2c_bus.write_byte(self.i2c_address,value&0x0F|currentvalue&0xF0)
+			self.e_strobe()
 		return
 
 	def sendcommand(self,value):
@@ -2047,6 +4974,14 @@ class Daisy14():
 		self.backled.off()
 		return
 
+	def close(self):
+		for line in (self.rs,self.e,self.backled):
+			if line!=-1:
+				line.close()
+		if self.i2c_bus!=-1:
+			release_i2c_bus(self.bus_id)
+			self.i2c_bus=-1
+
 ## DAISY-15 ############################################################
 
 class Daisy15():
@@ -2089,6 +5024,7 @@ class Daisy18():
 
 	fd=None
 	kernel_id=-1
+	owner=False
 
 	line_first = {
 		'CH1' :  '2',
@@ -2121,13 +5057,24 @@ class Daisy18():
 			
 		self.kernel_id = pinname2kernelid(connector + "." + pin)
 
-		export(self.kernel_id)
-		direction(self.kernel_id,'in')
+		request_line(self.kernel_id,'in')
+		self.owner=True
 
 		iopath=get_gpio_path(self.kernel_id)
 		if os.path.exists(iopath): 
 			self.fd = open(iopath + '/value','r')
 		
+	def close(self):
+		"""
+		Release the line, unexported when its last owner closes it
+		"""
+		if self.fd!=None:
+			self.fd.close()
+			self.fd=None
+		if self.owner:
+			release_line(self.kernel_id)
+			self.owner=False
+
 	def get(self):
 		if self.fd!=None:
 			self.fd.seek(0)
@@ -2136,28 +5083,28 @@ class Daisy18():
 				return False
 			else:
 				return True
-		return False
+		return get_value(self.kernel_id)==1
 
 	def state(self):
 		return self.get()
 
-	def wait_edge(self,fd,callback):
-		counter=0	
-		po = select.epoll()
-		po.register(fd,select.EPOLLET)
-		while True:
-			events = po.poll()
-			if counter>0:	
-				callback()
-			counter=counter+1
+	def set_edge(self,value,callback=None,debouncingtime=0,queue=None,glitchtime=0):
+		watch_edge(self.kernel_id,value,callback,debouncingtime,queue,glitchtime)
 
-	def set_edge(self,value,callback):
-		if self.fd!=None:
-			set_edge(self.kernel_id,value)
-			thread.start_new_thread(self.wait_edge,(self.fd,callback))
-			return
-		else:		
-			thread.exit()
+	def wait_edge(self,value="both",timeout=None):
+		"""
+		Coroutine returning the EdgeEvent of the next edge
+		"""
+		return async_wait_edge(self.kernel_id,value,timeout)
+
+	def edges(self,value="both"):
+		"""
+		Asynchronous iterator of the EdgeEvent of the line
+		"""
+		return async_edges(self.kernel_id,value)
+
+	async def get_async(self):
+		return self.get()
 
 ## DAISY-19 ############################################################
 
@@ -2169,6 +5116,7 @@ class Daisy19():
 	"""
 
 	kernel_id=-1
+	owner=False
 
 	outputs_first = {
 		'CH1' :  '2',
@@ -2201,9 +5149,17 @@ class Daisy19():
 		self.kernel_id = pinname2kernelid(connector_id + "." + pin)
 
 		if (self.kernel_id!=0):
-			export(self.kernel_id)
-			direction(self.kernel_id,'low')
+			request_line(self.kernel_id,'low')
+			self.owner=True
+
 
+	def close(self):
+		"""
+		Release the line, unexported when its last owner closes it
+		"""
+		if self.owner:
+			release_line(self.kernel_id)
+			self.owner=False
 
 	def on(self):
 		if (self.kernel_id!=0):
@@ -2248,6 +5204,63 @@ class Daisy20():
 		return(float(value)*self.volt_per_point)
 		
 
+## DAISY-22 ############################################################
+
+class Daisy22():
+
+	"""
+	DAISY-22 (8 bit I2C expander)
+	http://www.acmesystems.it/DAISY-22
+	"""
+
+	i2c_bus=-1
+	i2c_address=-1
+	line=-1
+
+	def __init__(self,bus_id=0,address=0x20,line=0):
+		self.bus_id=bus_id
+		self.i2c_bus = get_i2c_bus(bus_id)
+		self.i2c_address=address
+		self.line=line
+		return
+
+	def close(self):
+		if self.i2c_bus!=-1:
+			release_i2c_bus(self.bus_id)
+			self.i2c_bus=-1
+
+	def writebyte(self,value):
+		self.i2c_bus.write_byte(self.i2c_address,value)
+		return
+
+	def readbyte(self):
+		return self.i2c_bus.read_byte(self.i2c_address)
+
+	def on(self):
+		with self.i2c_bus:
+			currentvalue=self.i2c_bus.read_byte(self.i2c_address)
+			self.i2c_bus.write_byte(self.i2c_address,currentvalue|1<<self.line)
+		return
+
+	def off(self):
+		with self.i2c_bus:
+			currentvalue=self.i2c_bus.read_byte(self.i2c_address)
+			self.i2c_bus.write_byte(self.i2c_address,currentvalue&(255-(1<<self.line)))
+		return
+
+	def get(self):
+		with self.i2c_bus:
+			currentvalue=self.i2c_bus.read_byte(self.i2c_address)
+			self.i2c_bus.write_byte(self.i2c_address,currentvalue|(1<<self.line))
+			linevalue=self.i2c_bus.read_byte(self.i2c_address) & (1<<self.line)
+		return linevalue >> self.line
+
+	def pressed(self):
+		if self.get()==0:
+			return True
+		else:
+			return False
+
 ## DAISY-24 ############################################################
 
 class Daisy24():
@@ -2273,8 +5286,9 @@ class Daisy24():
 	K3 = -1 
 
 	def __init__(self,bus_id=0,exp_address=-1):
+		self.bus_id = bus_id
 		self.exp_address = exp_address
-		self.i2c_bus = smbus.SMBus(bus_id)
+		self.i2c_bus = get_i2c_bus(bus_id)
 		self.sendcommand(0x38)
 		self.sendcommand(0x39)
 		self.sendcommand(0x14) #Internal OSC freq
@@ -2383,6 +5397,14 @@ class Daisy24():
 
 		return False
 
+	def close(self):
+		for line in (self.K0,self.K1,self.K2,self.K3,self.backled):
+			if line!=-1:
+				line.close()
+		if self.i2c_bus!=-1:
+			release_i2c_bus(self.bus_id)
+			self.i2c_bus=-1
+
 #--------------------------------------------------------------
 
 w1path = "/sys/bus/w1/devices/w1 bus master"